@@ -1,8 +1,12 @@
 package edu.cmu.cs.ikea;
 
 import android.content.Intent;
+import android.graphics.Bitmap;
+import android.graphics.BitmapFactory;
 import android.os.Bundle;
+import android.os.SystemClock;
 import android.speech.tts.TextToSpeech;
+import android.util.DisplayMetrics;
 import android.util.Log;
 import android.view.View;
 import android.view.WindowManager;
@@ -22,6 +26,8 @@ import com.google.protobuf.ByteString;
 import com.google.protobuf.InvalidProtocolBufferException;
 
 import java.util.Locale;
+import java.util.UUID;
+import java.util.concurrent.ConcurrentHashMap;
 import java.util.function.Consumer;
 
 import edu.cmu.cs.gabriel.camera.CameraCapture;
@@ -32,6 +38,7 @@ import edu.cmu.cs.gabriel.client.results.ErrorType;
 import edu.cmu.cs.gabriel.protocol.Protos;
 import edu.cmu.cs.gabriel.protocol.Protos.InputFrame;
 import edu.cmu.cs.gabriel.protocol.Protos.ResultWrapper;
+import edu.cmu.cs.ikea.Protos.Display;
 import edu.cmu.cs.ikea.Protos.ToClientExtras;
 import edu.cmu.cs.ikea.Protos.ToClientExtras.ZoomInfo;
 import edu.cmu.cs.ikea.Protos.ToServerExtras;
@@ -45,6 +52,7 @@ public class GabrielActivity extends AppCompatActivity {
     private static final int PORT = 9099;
     private static final int WIDTH = 640;
     private static final int HEIGHT = 480;
+    private static final int JPEG_QUALITY = 67;
 
 
     public static final String EXTRA_APP_KEY = "edu.cmu.cs.gabriel.ikea.APP_KEY";
@@ -58,6 +66,20 @@ public class GabrielActivity extends AppCompatActivity {
     private YuvToJPEGConverter yuvToJPEGConverter;
     private CameraCapture cameraCapture;
     private edu.cmu.cs.ikea.Protos.State state;
+    private final String sessionId = UUID.randomUUID().toString();
+    private Display displayInfo;
+
+    // Long side of the frames that the server needs for the current step, or 0 for full size
+    private volatile int maxFrameWh;
+
+    // Set by the server while it is behind. 0 means no limit and the default quality.
+    private volatile int maxUploadFps;
+    private volatile int jpegQuality;
+    private volatile long lastUploadTime;
+
+    // Instruction images keyed by their hash. There is at most one image for each step, so
+    // this does not need to evict anything.
+    private final ConcurrentHashMap<String, ByteString> imageCache = new ConcurrentHashMap<>();
 
     private boolean onZoomCall;
     private String toSpeak;
@@ -70,8 +92,11 @@ public class GabrielActivity extends AppCompatActivity {
                     TextToSpeech.OnInitListener onInitListener = i -> textToSpeech.setLanguage(Locale.US);
                     GabrielActivity.this.textToSpeech = new TextToSpeech(GabrielActivity.this, onInitListener);
 
-                    ToServerExtras toServerExtras = ToServerExtras.newBuilder().setZoomStatus(
-                            ToServerExtras.ZoomStatus.STOP).build();
+                    ToServerExtras toServerExtras = ToServerExtras.newBuilder()
+                            .setZoomStatus(ToServerExtras.ZoomStatus.STOP)
+                            .setSessionId(sessionId)
+                            .setDisplay(displayInfo)
+                            .build();
                     InputFrame inputFrame = InputFrame.newBuilder().setExtras(
                             pack(toServerExtras)).build();
                     serverComm.send(inputFrame, SOURCE, true);
@@ -96,6 +121,15 @@ public class GabrielActivity extends AppCompatActivity {
         ImageView imageView = findViewById(R.id.imageView);
         ImageViewUpdater imageViewUpdater = new ImageViewUpdater(imageView);
 
+        // The server sends the smallest instruction image that fills this screen
+        DisplayMetrics displayMetrics = getResources().getDisplayMetrics();
+        this.displayInfo = Display.newBuilder()
+                .setWidth(displayMetrics.widthPixels)
+                .setHeight(displayMetrics.heightPixels)
+                .addImageFormats(Display.ImageFormat.WEBP)
+                .addImageFormats(Display.ImageFormat.JPEG)
+                .build();
+
         // Once this clinet is changed to support multiple tasks, we should start with an empty
         // state
         this.state = State.newBuilder()
@@ -106,9 +140,16 @@ public class GabrielActivity extends AppCompatActivity {
                 .build();
 
         Consumer<ResultWrapper> consumer = resultWrapper -> {
+            // Results without extras only give back a token
+            if (!resultWrapper.hasExtras()) {
+                return;
+            }
+
             try {
                 ToClientExtras toClientExtras = ToClientExtras.parseFrom(
                         resultWrapper.getExtras().getValue());
+                this.maxUploadFps = toClientExtras.getMaxUploadFps();
+                this.jpegQuality = toClientExtras.getJpegQuality();
 
                 if (toClientExtras.hasZoomInfo()) {
                     ZoomInfo zoomInfo = toClientExtras.getZoomInfo();
@@ -135,8 +176,10 @@ public class GabrielActivity extends AppCompatActivity {
                     return;
                 } else {
                     this.state = toClientExtras.getState();
+                    this.maxFrameWh = toClientExtras.getMaxFrameWh();
                 }
 
+                boolean receivedImage = false;
                 for (ResultWrapper.Result result : resultWrapper.getResultsList()) {
                     if (result.getPayloadType() == Protos.PayloadType.TEXT) {
                         String speech = result.getPayload().toStringUtf8();
@@ -144,8 +187,19 @@ public class GabrielActivity extends AppCompatActivity {
                     } else if (result.getPayloadType() == Protos.PayloadType.IMAGE) {
                         ByteString jpegByteString = result.getPayload();
                         imageViewUpdater.accept(jpegByteString);
+                        receivedImage = true;
+
+                        String imageHash = toClientExtras.getImageHash();
+                        if (!imageHash.isEmpty()) {
+                            imageCache.put(imageHash, jpegByteString);
+                        }
                     }
                 }
+
+                // The server leaves out images that we reported as cached
+                if (!receivedImage && imageCache.containsKey(toClientExtras.getImageHash())) {
+                    imageViewUpdater.accept(imageCache.get(toClientExtras.getImageHash()));
+                }
             } catch (InvalidProtocolBufferException e) {
                 Log.e(TAG, "Protobuf parse error", e);
             }
@@ -172,12 +226,32 @@ public class GabrielActivity extends AppCompatActivity {
                 return;
             }
 
+            int maxUploadFps = GabrielActivity.this.maxUploadFps;
+            if (maxUploadFps > 0 && SystemClock.elapsedRealtime() -
+                    GabrielActivity.this.lastUploadTime < 1000 / maxUploadFps) {
+                image.close();
+                return;
+            }
+
             serverComm.sendSupplier(() -> {
+                GabrielActivity.this.lastUploadTime = SystemClock.elapsedRealtime();
                 ByteString jpegByteString = GabrielActivity.this.yuvToJPEGConverter.convert(image);
+                int maxFrameWh = GabrielActivity.this.maxFrameWh;
+                if (maxFrameWh >= Math.max(WIDTH, HEIGHT)) {
+                    maxFrameWh = 0;
+                }
+                int jpegQuality = GabrielActivity.this.jpegQuality;
+                if (maxFrameWh > 0 || jpegQuality > 0) {
+                    jpegByteString = reencodeFrame(jpegByteString, maxFrameWh,
+                            jpegQuality > 0 ? jpegQuality : JPEG_QUALITY);
+                }
 
                 ToServerExtras toServerExtras = ToServerExtras.newBuilder()
                         .setZoomStatus(ToServerExtras.ZoomStatus.NO_CALL)
                         .setState(state)
+                        .setSessionId(sessionId)
+                        .setDisplay(displayInfo)
+                        .addAllCachedImageHashes(imageCache.keySet())
                         .build();
 
                 return InputFrame.newBuilder()
@@ -191,6 +265,33 @@ public class GabrielActivity extends AppCompatActivity {
         }
     };
 
+    /**
+     * Encode a JPEG frame again at jpegQuality. If maxFrameWh is not 0, the frame is scaled down so
+     * that its long side is at most maxFrameWh.
+     */
+    private static ByteString reencodeFrame(
+            ByteString jpegByteString, int maxFrameWh, int jpegQuality) {
+        byte[] jpegBytes = jpegByteString.toByteArray();
+
+        // The decoder skips most of the work when it can downsample by a power of two
+        BitmapFactory.Options options = new BitmapFactory.Options();
+        if (maxFrameWh > 0) {
+            options.inSampleSize = Math.max(WIDTH, HEIGHT) / maxFrameWh;
+        }
+        Bitmap bitmap = BitmapFactory.decodeByteArray(jpegBytes, 0, jpegBytes.length, options);
+
+        int longSide = Math.max(bitmap.getWidth(), bitmap.getHeight());
+        if (maxFrameWh > 0 && longSide > maxFrameWh) {
+            bitmap = Bitmap.createScaledBitmap(bitmap,
+                    bitmap.getWidth() * maxFrameWh / longSide,
+                    bitmap.getHeight() * maxFrameWh / longSide, true);
+        }
+
+        ByteString.Output output = ByteString.newOutput();
+        bitmap.compress(Bitmap.CompressFormat.JPEG, jpegQuality, output);
+        return output.toByteString();
+    }
+
     @Override
     protected void onDestroy() {
         super.onDestroy();
@@ -202,6 +303,7 @@ public class GabrielActivity extends AppCompatActivity {
         ToServerExtras extras = ToServerExtras.newBuilder()
                 .setZoomStatus(ToServerExtras.ZoomStatus.START)
                 .setState(state)
+                .setSessionId(sessionId)
                 .build();
         InputFrame inputFrame = InputFrame.newBuilder().setExtras(pack(extras)).build();
         this.onZoomCall = true;
@@ -0,0 +1,63 @@
+'''Pick a load level from the latency of recent frames.
+
+Level 0 means the node keeps up. Each higher level means clients should
+send less. The level goes up one step when the moving average latency is
+over the target, and down one step when it is under a fraction of the
+target. It changes at most once every hold seconds, so that the effect of
+the last change shows up in the latency before the next one.'''
+
+import time
+
+
+# Weight of the newest frame in the moving average latency
+LATENCY_SMOOTHING = 0.2
+
+# The level only goes down once the latency is under this fraction of the
+# target
+IDLE_FRACTION = 0.5
+
+# Default seconds between level changes
+HOLD = 2
+
+
+class LoadLevel:
+    def __init__(self, num_levels, target_latency, hold=HOLD):
+        self._num_levels = num_levels
+        self._target_latency = target_latency
+        self._hold = hold
+        self._level = 0
+        self._latency = None
+        self._last_change = time.monotonic()
+
+    def get(self):
+        return self._level
+
+    def get_latency(self):
+        '''Return the moving average of seconds per frame, or 0 if no
+        frame has been observed.'''
+        return 0 if self._latency is None else self._latency
+
+    def observe(self, latency):
+        '''Add the seconds between a frame arriving and its result being
+        ready. Return True if the level changed.'''
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+
+        now = time.monotonic()
+        if now - self._last_change < self._hold:
+            return False
+
+        if self._latency > self._target_latency:
+            new_level = min(self._level + 1, self._num_levels - 1)
+        elif self._latency < self._target_latency * IDLE_FRACTION:
+            new_level = max(self._level - 1, 0)
+        else:
+            new_level = self._level
+
+        if new_level == self._level:
+            return False
+        self._level = new_level
+        self._last_change = now
+        return True
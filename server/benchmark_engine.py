@@ -0,0 +1,245 @@
+'''Replay frames through IkeaEngine.handle and report the time spent in each
+stage.
+
+Frames come from a directory of images, or are generated. Each frame is sent
+with ToServerExtras for one of several simulated sessions, on a step that
+needs the detector. With --recording, the frames of a recording are replayed
+as they were sent, and results that differ from the recorded results are
+counted. With --detector stub, no model files, GPU or network are needed.
+
+Run from the server directory, e.g.:
+    python3 benchmark_engine.py --detector stub --num-frames 500
+    python3 benchmark_engine.py --detector opencv_cpu --image-dir frames/
+    python3 benchmark_engine.py --detector caffe_gpu --recording rec/
+'''
+
+import argparse
+import glob
+import logging
+import os
+import time
+import zlib
+
+import cv2
+import numpy as np
+from gabriel_protocol import gabriel_pb2
+
+import cv_rules
+import detector
+import ikea_pb2
+from ikea_engine import IkeaEngine
+import message_bus
+from recording import RecordingReader
+
+
+STUB = 'stub'
+
+SYNTHETIC_IMG_SIZE = (480, 640, 3)
+PERCENTILES = (50, 95, 99)
+
+# Steps that need the detector
+STEPS = tuple(cv_rules.CLASSES_FOR_STEP)
+
+# ToClientExtras fields that depend on the load of the engine, rather than on
+# the frame
+PACING_FIELDS = ('max_upload_fps', 'jpeg_quality')
+
+
+logger = logging.getLogger(__name__)
+
+
+class StubDetector(detector.Detector):
+    '''Returns the same random proposals every time it sees the same image.
+
+    The outputs have the shapes that the real network gives, so decoding
+    and NMS do the same amount of work.'''
+
+    def __init__(self, num_rois, latency):
+        super().__init__()
+        self._num_rois = num_rois
+        self._latency = latency
+
+    def _forward(self, img, img_scale):
+        if self._latency > 0:
+            time.sleep(self._latency)
+
+        height, width = img.shape[:2]
+        rng = np.random.RandomState(zlib.crc32(img[::16, ::16].tobytes()))
+        corners = rng.uniform(0, 1, (self._num_rois, 4)) * [
+            width, height, width, height]
+        boxes = np.hstack((np.minimum(corners[:, :2], corners[:, 2:]),
+                           np.maximum(corners[:, :2], corners[:, 2:])))
+
+        logits = rng.normal(0, 3, (self._num_rois, cv_rules.CLASS_IDX_LIMIT))
+        scores = np.exp(logits)
+        scores /= scores.sum(axis=1, keepdims=True)
+
+        box_deltas = rng.normal(
+            0, 0.1, (self._num_rois, 4 * cv_rules.CLASS_IDX_LIMIT))
+        return (scores.astype(np.float32), boxes.astype(np.float32),
+                box_deltas.astype(np.float32))
+
+
+def load_jpegs(image_dir, num_frames, seed):
+    if image_dir is None:
+        rng = np.random.RandomState(seed)
+        imgs = [rng.randint(0, 256, SYNTHETIC_IMG_SIZE, dtype=np.uint8)
+                for _ in range(num_frames)]
+    else:
+        paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')) +
+                       glob.glob(os.path.join(image_dir, '*.png')))
+        imgs = [cv2.imread(path, cv2.IMREAD_COLOR) for path in paths]
+
+    return [cv2.imencode('.jpg', img)[1].tobytes() for img in imgs]
+
+
+def make_input_frames(jpegs, num_frames, num_sessions, seed):
+    rng = np.random.RandomState(seed)
+    input_frames = []
+    for i in range(num_frames):
+        to_server_extras = ikea_pb2.ToServerExtras()
+        to_server_extras.session_id = 'session-{}'.format(i % num_sessions)
+        to_server_extras.state.step = STEPS[rng.randint(len(STEPS))]
+        to_server_extras.state.update_count = i
+
+        input_frame = gabriel_pb2.InputFrame()
+        input_frame.payload_type = gabriel_pb2.PayloadType.IMAGE
+        input_frame.payloads.append(jpegs[i % len(jpegs)])
+        input_frame.extras.Pack(to_server_extras)
+        input_frames.append(input_frame)
+
+    return input_frames
+
+
+def without_pacing(to_client_extras):
+    '''Return to_client_extras without PACING_FIELDS.'''
+    for field in PACING_FIELDS:
+        to_client_extras.ClearField(field)
+    return to_client_extras
+
+
+def load_recording(directory, num_frames):
+    '''Return InputFrames and the recorded ToClientExtras without
+    PACING_FIELDS for the first num_frames records, or every record if
+    num_frames is 0, and the number of records that were skipped.
+
+    Frames that start or stop a Zoom call are skipped. Starting a call
+    needs credentials.py, and stopping one waits for the HTTP server.'''
+    reader = RecordingReader(directory)
+    if num_frames > 0:
+        num_records = min(num_frames, len(reader))
+    else:
+        num_records = len(reader)
+
+    input_frames = []
+    recorded_results = []
+    num_skipped = 0
+    for i in range(num_records):
+        record = reader[i]
+        to_server_extras = record.get_to_server_extras()
+        if (to_server_extras.zoom_status !=
+                ikea_pb2.ToServerExtras.ZoomStatus.NO_CALL):
+            num_skipped += 1
+            continue
+
+        input_frame = gabriel_pb2.InputFrame()
+        input_frame.payload_type = gabriel_pb2.PayloadType.IMAGE
+        input_frame.payloads.append(record.payload)
+        input_frame.extras.Pack(to_server_extras)
+        input_frames.append(input_frame)
+        recorded_results.append(without_pacing(record.get_to_client_extras()))
+
+    return input_frames, recorded_results, num_skipped
+
+
+def print_report(stage_timer, num_frames, elapsed):
+    print('{} frames in {:.2f} s, {:.1f} frames/s'.format(
+        num_frames, elapsed, num_frames / elapsed))
+    print('{:<12} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'stage', 'count', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for stage in stage_timer.get_stages():
+        count = stage_timer.get_count(stage)
+        percentiles = stage_timer.get_percentiles(stage, PERCENTILES) * 1000
+        print('{:<12} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            stage, count, stage_timer.get_total(stage) / count * 1000,
+            *percentiles))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--detector', default=STUB,
+                        choices=(STUB,) + detector.BACKENDS)
+    parser.add_argument('--image-dir',
+                        help='Directory of frames. Random frames are used if '
+                        'this is not given.')
+    parser.add_argument('--recording',
+                        help='Directory of a recording to replay')
+    parser.add_argument('--num-frames', type=int, default=200,
+                        help='With --recording, 0 replays every frame')
+    parser.add_argument('--num-sessions', type=int, default=4)
+    parser.add_argument('--stub-rois', type=int, default=300,
+                        help='Number of proposals from the stub detector')
+    parser.add_argument('--stub-latency-ms', type=float, default=0,
+                        help='Time that the stub detector sleeps per frame')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.detector == STUB:
+        det = StubDetector(args.stub_rois, args.stub_latency_ms / 1000)
+    else:
+        det = detector.create_detector(args.detector)
+
+    recorded_results = None
+    if args.recording is not None:
+        input_frames, recorded_results, num_skipped = load_recording(
+            args.recording, args.num_frames)
+        if num_skipped > 0:
+            print('Skipped {} frames that start or stop a Zoom call'.format(
+                num_skipped))
+    else:
+        jpegs = load_jpegs(args.image_dir, args.num_frames, args.seed)
+        if len(jpegs) == 0:
+            raise Exception('No images found')
+        input_frames = make_input_frames(
+            jpegs, args.num_frames, args.num_sessions, args.seed)
+    if len(input_frames) == 0:
+        raise Exception('No frames found')
+
+    # Nothing reads the other end. No frame starts or stops a Zoom call, so
+    # the engine never waits for a reply.
+    engine_sock, _ = message_bus.create_socket_pair()
+    engine = IkeaEngine(engine_sock, det=det)
+
+    stage_timer = engine.get_stage_timer()
+    stage_timer.clear()
+    num_changed = 0
+    start = time.perf_counter()
+    for i, input_frame in enumerate(input_frames):
+        with stage_timer.measure('handle'):
+            result_wrapper = engine.handle(input_frame)
+        with stage_timer.measure('serialize'):
+            result_wrapper.SerializeToString()
+        if recorded_results is None:
+            continue
+
+        # The pacing depends on how busy the engine was, so it is left out.
+        # Messages are compared rather than bytes, because concatenated
+        # values, such as pacing appended to the extras, serialize to
+        # different bytes than the same message serialized in one go.
+        to_client_extras = ikea_pb2.ToClientExtras()
+        if result_wrapper.extras.Is(ikea_pb2.ToClientExtras.DESCRIPTOR):
+            result_wrapper.extras.Unpack(to_client_extras)
+        if without_pacing(to_client_extras) != recorded_results[i]:
+            num_changed += 1
+    elapsed = time.perf_counter() - start
+
+    print_report(stage_timer, len(input_frames), elapsed)
+    if recorded_results is not None:
+        print('{} of {} results differ from the recording'.format(
+            num_changed, len(input_frames)))
+
+
+if __name__ == '__main__':
+    # Every state change is logged at INFO
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,100 @@
+'''Move detections from a keyframe forward with sparse optical flow.
+
+Corners are found inside each box on the keyframe, and followed from frame
+to frame with pyramidal Lucas-Kanade. Each box moves by the median motion of
+its corners. Tracking gives up, so that the caller runs the detector again,
+when a box loses too many corners or the scene changes.'''
+
+import cv2
+import numpy as np
+
+import geometry
+
+
+MAX_CORNERS_PER_BOX = 20
+MIN_CORNERS_PER_BOX = 4
+
+
+class BoxTracker:
+    '''Tracks the boxes from one keyframe for one session.
+
+    dets has rows in [x1, y1, x2, y2, confidence, class index] format. A
+    frame counts as a scene change if the mean difference between its
+    thumbnail and the keyframe's thumbnail is more than scene_change_diff
+    gray levels. Thumbnails come from thumbnails.gray_thumbnail.'''
+
+    def __init__(self, step, img, thumbnail, dets, scene_change_diff):
+        self._step = step
+        self._img_shape = img.shape
+        self._gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        self._keyframe_thumbnail = thumbnail
+        self._dets = dets.copy()
+        self._scene_change_diff = scene_change_diff
+        self._num_tracked = 0
+
+        self._corners = [self._find_corners(box) for box in dets[:, :4]]
+
+    def get_step(self):
+        return self._step
+
+    def get_num_tracked(self):
+        '''Return the number of frames tracked since the keyframe.'''
+        return self._num_tracked
+
+    def _find_corners(self, box):
+        x1, y1, x2, y2 = np.round(box).astype(int)
+        mask = np.zeros_like(self._gray)
+        mask[y1:y2 + 1, x1:x2 + 1] = 255
+        corners = cv2.goodFeaturesToTrack(
+            self._gray, MAX_CORNERS_PER_BOX, 0.01, 3, mask=mask)
+        if corners is None:
+            return np.empty((0, 1, 2), dtype=np.float32)
+        return corners
+
+    def track(self, img, thumbnail):
+        '''Return the boxes moved to img, or None if they could not be
+        tracked. thumbnail is the thumbnail of img.'''
+        if img.shape != self._img_shape:
+            return None
+        if any(len(corners) < MIN_CORNERS_PER_BOX
+               for corners in self._corners):
+            return None
+
+        thumbnail_diff = cv2.norm(
+            thumbnail, self._keyframe_thumbnail, cv2.NORM_L1)
+        if (thumbnail_diff / self._keyframe_thumbnail.size >
+                self._scene_change_diff):
+            return None
+
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        if len(self._dets) > 0:
+            old_corners = np.concatenate(self._corners)
+            new_corners, status, _ = cv2.calcOpticalFlowPyrLK(
+                self._gray, gray, old_corners, None)
+            found = status[:, 0] == 1
+
+            start = 0
+            for i, corners in enumerate(self._corners):
+                end = start + len(corners)
+                box_found = found[start:end]
+                if box_found.sum() < MIN_CORNERS_PER_BOX:
+                    return None
+
+                motion = np.median(
+                    new_corners[start:end][box_found] -
+                    corners[box_found], axis=0)[0]
+                self._dets[i, [0, 2]] += motion[geometry.X]
+                self._dets[i, [1, 3]] += motion[geometry.Y]
+                self._corners[i] = new_corners[start:end][box_found]
+                start = end
+
+            height, width = self._img_shape[:2]
+            self._dets[:, [0, 2]] = np.clip(
+                self._dets[:, [0, 2]], 0, width - 1)
+            self._dets[:, [1, 3]] = np.clip(
+                self._dets[:, [1, 3]], 0, height - 1)
+
+        self._gray = gray
+        self._num_tracked += 1
+        return self._dets.copy()
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+# These follow the conventions of py-faster-rcnn (fast_rcnn/bbox_transform.py
+# and nms/py_cpu_nms.py), so that backends that do not link against
+# py-faster-rcnn produce the same boxes as im_detect.
+
+
+def bbox_transform_inv(boxes, deltas):
+    if boxes.shape[0] == 0:
+        return np.zeros((0, deltas.shape[1]), dtype=deltas.dtype)
+
+    boxes = boxes.astype(deltas.dtype, copy=False)
+
+    widths = boxes[:, 2] - boxes[:, 0] + 1.0
+    heights = boxes[:, 3] - boxes[:, 1] + 1.0
+    ctr_x = boxes[:, 0] + 0.5 * widths
+    ctr_y = boxes[:, 1] + 0.5 * heights
+
+    dx = deltas[:, 0::4]
+    dy = deltas[:, 1::4]
+    dw = deltas[:, 2::4]
+    dh = deltas[:, 3::4]
+
+    pred_ctr_x = dx * widths[:, np.newaxis] + ctr_x[:, np.newaxis]
+    pred_ctr_y = dy * heights[:, np.newaxis] + ctr_y[:, np.newaxis]
+    pred_w = np.exp(dw) * widths[:, np.newaxis]
+    pred_h = np.exp(dh) * heights[:, np.newaxis]
+
+    pred_boxes = np.zeros(deltas.shape, dtype=deltas.dtype)
+    pred_boxes[:, 0::4] = pred_ctr_x - 0.5 * pred_w
+    pred_boxes[:, 1::4] = pred_ctr_y - 0.5 * pred_h
+    pred_boxes[:, 2::4] = pred_ctr_x + 0.5 * pred_w
+    pred_boxes[:, 3::4] = pred_ctr_y + 0.5 * pred_h
+
+    return pred_boxes
+
+
+def clip_boxes(boxes, im_shape):
+    boxes[:, 0::4] = np.maximum(np.minimum(boxes[:, 0::4], im_shape[1] - 1), 0)
+    boxes[:, 1::4] = np.maximum(np.minimum(boxes[:, 1::4], im_shape[0] - 1), 0)
+    boxes[:, 2::4] = np.maximum(np.minimum(boxes[:, 2::4], im_shape[1] - 1), 0)
+    boxes[:, 3::4] = np.maximum(np.minimum(boxes[:, 3::4], im_shape[0] - 1), 0)
+    return boxes
+
+
+def batched_nms(boxes, scores, cls_idxs, thresh):
+    '''Run nms on the boxes of every class at once.
+
+    Boxes are offset by their class index so that boxes from different classes
+    never overlap. Return the indexes of the boxes to keep, in order of
+    decreasing score.'''
+    if boxes.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Coordinates are float32, so these sums are exact in float64
+    boxes = boxes.astype(np.float64)
+    offsets = cls_idxs * (boxes.max() + 2)
+    x1 = boxes[:, 0] + offsets
+    y1 = boxes[:, 1] + offsets
+    x2 = boxes[:, 2] + offsets
+    y2 = boxes[:, 3] + offsets
+
+    order = scores.argsort()[::-1]
+    x1 = x1[order]
+    y1 = y1[order]
+    x2 = x2[order]
+    y2 = y2[order]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    w = np.maximum(0.0, np.minimum(x2[:, np.newaxis], x2) -
+                   np.maximum(x1[:, np.newaxis], x1) + 1)
+    h = np.maximum(0.0, np.minimum(y2[:, np.newaxis], y2) -
+                   np.maximum(y1[:, np.newaxis], y1) + 1)
+    inter = w * h
+    suppresses = (inter / (areas[:, np.newaxis] + areas - inter)) > thresh
+
+    # Only the kept boxes are visited, and there are few of these after
+    # thresholding
+    num_boxes = order.shape[0]
+    suppressed = np.zeros(num_boxes, dtype=bool)
+    keep = []
+    for i in range(num_boxes):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= suppresses[i]
+
+    return order[keep]
@@ -0,0 +1,57 @@
+import logging
+import os
+import sys
+
+from detector import Detector
+from detector import PROTOTXT_NAME
+from detector import CAFFEMODEL_NAME
+from detector import get_blobs
+
+faster_rcnn_root = os.getenv('FASTER_RCNN_ROOT', '.')
+sys.path.append(os.path.join(faster_rcnn_root, "tools"))
+import _init_paths  # this is necessary
+from fast_rcnn.config import cfg as faster_rcnn_config
+sys.path.append(os.path.join(faster_rcnn_root, "python"))
+import caffe
+
+
+faster_rcnn_config.TEST.HAS_RPN = True  # Use RPN for proposals
+
+logger = logging.getLogger(__name__)
+
+
+class CaffeDetector(Detector):
+    def __init__(self, gpu_id, model_dir):
+        super().__init__()
+        caffe.set_mode_gpu()
+        caffe.set_device(gpu_id)
+        faster_rcnn_config.GPU_ID = gpu_id
+
+        self.net = caffe.Net(os.path.join(model_dir, PROTOTXT_NAME),
+                             os.path.join(model_dir, CAFFEMODEL_NAME),
+                             caffe.TEST)
+        logger.info('Caffe net from %s has been initilized on GPU %d',
+                    model_dir, gpu_id)
+
+    def _forward(self, img, img_scale):
+        # This is im_detect from py-faster-rcnn's fast_rcnn/test.py, without
+        # decoding every box
+        data, im_info, img_scale = get_blobs(
+            img, self._blob_buffers, img_scale=img_scale)
+
+        # Inputs are padded to a few shapes, so this is usually the same
+        if self.net.blobs['data'].data.shape != data.shape:
+            self.net.blobs['data'].reshape(*data.shape)
+            self.net.blobs['im_info'].reshape(*im_info.shape)
+        blobs_out = self.net.forward(data=data, im_info=im_info)
+
+        # Detections are post-processed lazily, so these must not be views of
+        # blobs that the next forward pass overwrites
+        rois = self.net.blobs['rois'].data.copy()
+        scores = blobs_out['cls_prob'].copy()
+        box_deltas = blobs_out['bbox_pred'].copy()
+
+        # Unscale back to raw image space
+        boxes = rois[:, 1:5] / img_scale
+
+        return scores, boxes, box_deltas
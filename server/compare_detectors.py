@@ -0,0 +1,100 @@
+'''Compare latency and output of the detector backends on the same frames.
+
+Run from the server directory, e.g.:
+    python3 compare_detectors.py --image-dir frames/ --backends caffe_gpu \
+        opencv_cpu
+'''
+
+import argparse
+import glob
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+import cv_rules
+import detector
+
+
+DUMMY_IMG_SIZE = (480, 640, 3)
+NUM_WARMUP = 2
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_images(image_dir, num_dummy):
+    if image_dir is None:
+        rng = np.random.RandomState(0)
+        return [rng.randint(0, 256, DUMMY_IMG_SIZE, dtype=np.uint8)
+                for _ in range(num_dummy)]
+
+    paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')) +
+                   glob.glob(os.path.join(image_dir, '*.png')))
+    return [cv2.imread(path, cv2.IMREAD_COLOR) for path in paths]
+
+
+def time_backend(backend, images, repeats):
+    det = detector.create_detector(backend)
+    for _ in range(NUM_WARMUP):
+        det.detect(images[0], cv_rules.ALL_CLASSES).get_array()
+
+    latencies = []
+    outputs = []
+    for _ in range(repeats):
+        for img in images:
+            start = time.perf_counter()
+            dets_for_class = det.detect(img, cv_rules.ALL_CLASSES)
+            # Detections are post-processed lazily, so this is part of the
+            # time that each frame takes
+            dets_for_class.get_array()
+            latencies.append(time.perf_counter() - start)
+            outputs.append(dets_for_class)
+
+    return np.array(latencies) * 1000, outputs[:len(images)]
+
+
+def count_mismatches(reference, outputs):
+    '''Count frames where some class has a different number of detections.'''
+    mismatches = 0
+    for ref_dets, dets in zip(reference, outputs):
+        if any(len(ref_dets[cls_idx]) != len(dets[cls_idx])
+               for cls_idx in cv_rules.ALL_CLASSES):
+            mismatches += 1
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+',
+                        default=(detector.CAFFE_GPU, detector.OPENCV_CPU),
+                        choices=detector.BACKENDS)
+    parser.add_argument('--image-dir',
+                        help='Directory of frames. Random frames are used if '
+                        'this is not given.')
+    parser.add_argument('--num-dummy', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    images = load_images(args.image_dir, args.num_dummy)
+    if len(images) == 0:
+        raise Exception('No images found')
+
+    reference = None
+    print('{:<12} {:>9} {:>9} {:>9} {:>9}'.format(
+        'backend', 'mean ms', 'p50 ms', 'p95 ms', 'mismatch'))
+    for backend in args.backends:
+        latencies, outputs = time_backend(backend, images, args.repeats)
+        if reference is None:
+            reference = outputs
+        mismatches = count_mismatches(reference, outputs)
+        print('{:<12} {:>9.2f} {:>9.2f} {:>9.2f} {:>5}/{:<3}'.format(
+            backend, latencies.mean(), np.percentile(latencies, 50),
+            np.percentile(latencies, 95), mismatches, len(images)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
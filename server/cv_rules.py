@@ -1,10 +1,15 @@
+import collections
+import concurrent.futures
 from enum import Enum
 import os
 import logging
 
 import ikea_pb2
 from gabriel_protocol import gabriel_pb2
-from gabriel_server import cognitive_engine
+
+import geometry
+import image_variants
+import serialized_result
 
 
 logger = logging.getLogger(__name__)
@@ -17,6 +22,50 @@ ONE_WIRE_INSTRUCTION_BYTES = ('You have inserted one wire. Now insert the '
                               'second wire to support the shade.'.encode())
 
 
+def _text_result(text_bytes):
+    result = gabriel_pb2.ResultWrapper.Result()
+    result.payload_type = gabriel_pb2.PayloadType.TEXT
+    result.payload = text_bytes
+    return result
+
+
+def _image_result(image_bytes):
+    result = gabriel_pb2.ResultWrapper.Result()
+    result.payload_type = gabriel_pb2.PayloadType.IMAGE
+    result.payload = image_bytes
+    return result
+
+
+ONE_WIRE_INSTRUCTION = serialized_result.serialize_results(
+    (_text_result(ONE_WIRE_INSTRUCTION_BYTES),))
+
+TO_CLIENT_EXTRAS_TYPE_URL = (
+    'type.googleapis.com/' + ikea_pb2.ToClientExtras.DESCRIPTOR.full_name)
+
+# Number of times that each State has been entered in this process
+_transition_counts = collections.Counter()
+
+
+def get_transition_counts():
+    '''Return a dict from State name to the number of times that the State
+    has been entered in this process.'''
+    return dict(_transition_counts)
+
+
+class ClientInfo:
+    '''What a client can show, and which instruction images it has cached.'''
+
+    def __init__(self, display, cached_image_hashes):
+        self._display = display
+        self._cached_image_hashes = cached_image_hashes
+
+    def get_display(self):
+        return self._display
+
+    def get_cached_image_hashes(self):
+        return self._cached_image_hashes
+
+
 class State(Enum):
     BASE = ('Put the base on the table.', 'base.png',
             ikea_pb2.State.Step.BASE)
@@ -39,48 +88,102 @@ class State(Enum):
             'lamp.png', ikea_pb2.State.Step.DONE)
 
     def __init__(self, speech, image_filename, proto_step):
-        self._speech_bytes = speech.encode()
-        image_path = os.path.join(IMAGE_DIR, image_filename)
-        self._image_bytes = open(image_path, 'rb').read()
+        self._speech = speech
+        self._image_filename = image_filename
         self._proto_step = proto_step
 
+    def get_image_filename(self):
+        return self._image_filename
+
+    def _load(self, variants):
+        '''Build the results for this state. variants is the output of
+        image_variants.make_variants for its image.'''
+        self._image_variants = variants
+        self._image_hashes = {
+            key: image_variants.content_hash(image_bytes)
+            for key, image_bytes in self._image_variants.items()
+        }
+
+        # Everything but the counters and image_hash is the same for every
+        # frame, so it is serialized once here
+        speech_result = _text_result(self._speech.encode())
+        self._serialized_speech = serialized_result.serialize_results(
+            (speech_result,))
+        self._serialized_updates = {
+            key: serialized_result.serialize_results(
+                (speech_result, _image_result(image_bytes)))
+            for key, image_bytes in self._image_variants.items()
+        }
+
+        static_extras = ikea_pb2.ToClientExtras()
+        static_extras.state.step = self._proto_step
+        static_extras.max_frame_wh = MAX_FRAME_WH_FOR_STEP.get(
+            self._proto_step, 0)
+        self._serialized_static_extras = static_extras.SerializeToString()
+
     def get_proto_step(self):
         return self._proto_step
 
-    def update_result_wrapper(self, update_count):
-        status = gabriel_pb2.ResultWrapper.Status.SUCCESS
-        result_wrapper = cognitive_engine.create_result_wrapper(status)
+    def _result_wrapper(self, serialized_results, update_count,
+                        frames_with_one_buckle, frames_with_two_buckles,
+                        image_hash=''):
+        '''Return a SerializedResultWrapper. The extras are the static
+        ToClientExtras for this state, followed by the fields that change
+        between frames.'''
+        dynamic_extras = ikea_pb2.ToClientExtras()
+        dynamic_extras.image_hash = image_hash
+        dynamic_extras.state.update_count = update_count
+        dynamic_extras.state.frames_with_one_buckle = frames_with_one_buckle
+        dynamic_extras.state.frames_with_two_buckles = frames_with_two_buckles
+        return serialized_result.SerializedResultWrapper(
+            serialized_results, TO_CLIENT_EXTRAS_TYPE_URL,
+            self._serialized_static_extras +
+            dynamic_extras.SerializeToString())
+
+    def update_result_wrapper(self, update_count, client_info):
+        '''client_info is a ClientInfo. Its display picks the variant of the
+        image, and the image is left out if the client has it cached.'''
+        logger.info('Updated State: %s', self.name)
+        _transition_counts[self.name] += 1
+        key = image_variants.select(
+            self._image_variants, client_info.get_display())
+        image_hash = self._image_hashes[key]
+        if image_hash in client_info.get_cached_image_hashes():
+            serialized_results = self._serialized_speech
+        else:
+            serialized_results = self._serialized_updates[key]
 
-        result = gabriel_pb2.ResultWrapper.Result()
-        result.payload_type = gabriel_pb2.PayloadType.TEXT
-        result.payload = self._speech_bytes
-        result_wrapper.results.append(result)
+        return self._result_wrapper(
+            serialized_results, update_count, 0, 0, image_hash)
 
-        result = gabriel_pb2.ResultWrapper.Result()
-        result.payload_type = gabriel_pb2.PayloadType.IMAGE
-        result.payload = self._image_bytes
-        result_wrapper.results.append(result)
+    def result_wrapper_without_update(self, update_count,
+                                      frames_with_one_buckle=0,
+                                      frames_with_two_buckles=0):
+        return self._result_wrapper(
+            b'', update_count, frames_with_one_buckle, frames_with_two_buckles)
 
-        logger.info('Updated State: %s', self.name)
 
-        to_client_extras = ikea_pb2.ToClientExtras()
-        to_client_extras.state.update_count = update_count
-        to_client_extras.state.step = self.get_proto_step()
+FIRST_STATE = State.BASE
 
-        result_wrapper.extras.Pack(to_client_extras)
 
-        return result_wrapper
+def _read_variants(image_filename):
+    with open(os.path.join(IMAGE_DIR, image_filename), 'rb') as f:
+        return image_variants.make_variants(f.read())
 
-    def result_wrapper_without_update(self, update_count):
-        status = gabriel_pb2.ResultWrapper.Status.SUCCESS
-        result_wrapper = cognitive_engine.create_result_wrapper(status)
 
-        to_client_extras = ikea_pb2.ToClientExtras()
-        to_client_extras.state.update_count = update_count
-        to_client_extras.state.step = self._proto_step
+def load_assets():
+    '''Read and encode the instruction images, and build the results for
+    every State. This must be called before any results are made.
 
-        result_wrapper.extras.Pack(to_client_extras)
-        return result_wrapper
+    Images are encoded on several threads, because OpenCV releases the
+    GIL.'''
+    image_filenames = sorted({state.get_image_filename() for state in State})
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        variants = dict(zip(image_filenames, executor.map(
+            _read_variants, image_filenames)))
+
+    for state in State:
+        state._load(variants[state.get_image_filename()])
 
 
 # Class indexes come from the following code:
@@ -102,167 +205,211 @@ BASE = 7
 SHADE = 8
 BULB = 9
 
+CLASS_IDX_LIMIT = BULB + 1  # Bulb has the highest index
 
-def base_result(dets_for_class, update_count):
-    if len(dets_for_class[BASE]) == 0:
-        return State.BASE.result_wrapper_without_update(update_count)
+# Start from 1 because 0 is the background
+ALL_CLASSES = tuple(range(1, CLASS_IDX_LIMIT))
 
-    return State.PIPE.update_result_wrapper(update_count + 1)
 
+# Number of frames in a row with two buckles that finish the BUCKLE step
+# once it is exceeded, and number of frames in a row with one buckle that
+# trigger ONE_WIRE_INSTRUCTION
+FRAMES_WITH_TWO_BUCKLES_TO_ADVANCE = 3
+FRAMES_WITH_ONE_BUCKLE_FOR_INSTRUCTION = 5
 
-def pipe_result(dets_for_class, update_count):
-    bases = dets_for_class[BASE]
-    pipes = dets_for_class[PIPE]
-    if (len(bases) == 0) or (len(pipes) == 0):
-        return State.PIPE.result_wrapper_without_update(update_count)
 
-    for base in bases:
-        base_center = ((base[0] + base[2]) / 2, (base[1] + base[3]) / 2)
-        base_width = base[2] - base[0]
-        base_height = base[3] - base[1]
-        for pipe in pipes:
-            pipe_center = ((pipe[0] + pipe[2]) / 2, (pipe[1] + pipe[3]) / 2)
-            pipe_height = pipe[3] - pipe[1]
-            if pipe_center[1] > base_center[1]:
-                continue
-            if pipe_center[0] < base_center[0] - base_width * 0.25 or (
-                    pipe_center[0] > base_center[0] + base_width * 0.25):
-                continue
-            if pipe_height / base_height < 1.5:
-                continue
+def _advance_rule(step_rule, dets_for_class, old_state, client_info):
+    '''Move to the next state as soon as the predicate holds.'''
+    if (step_rule.predicate is None) or step_rule.predicate(dets_for_class):
+        return step_rule.next_state.update_result_wrapper(
+            old_state.update_count + 1, client_info)
 
-            return State.SHADE.update_result_wrapper(update_count + 1)
+    return step_rule.state.result_wrapper_without_update(
+        old_state.update_count)
 
-    return State.PIPE.result_wrapper_without_update(update_count)
 
+def _pipe_on_base(dets_for_class):
+    bases = dets_for_class[BASE]
+    pipes = dets_for_class[PIPE]
 
-def shade_result(dets_for_class, update_count):
-    if len(dets_for_class[SHADE]) == 0:
-        return State.SHADE.result_wrapper_without_update(update_count)
+    # Each matrix has a row for each base and a column for each pipe
+    base_centers = geometry.centers(bases)
+    pipe_centers = geometry.centers(pipes)
+    pipe_above_base = ~geometry.greater(
+        base_centers, pipe_centers, geometry.Y)
+    pipe_centered = geometry.within_band(
+        base_centers, geometry.widths(bases), 0.25, pipe_centers, geometry.X)
+    pipe_tall_enough = ~(geometry.ratios(
+        geometry.heights(bases), geometry.heights(pipes)) < 1.5)
 
-    return State.BUCKLE.update_result_wrapper(update_count + 1)
+    return (pipe_above_base & pipe_centered & pipe_tall_enough).any()
 
 
 def _count_buckles(shadetops, buckles):
-    for shadetop in shadetops:
-        shadetop_center = ((shadetop[0] + shadetop[2]) / 2,
-                           (shadetop[1] + shadetop[3]) / 2)
-        shadetop_width = shadetop[2] - shadetop[0]
-        shadetop_height = shadetop[3] - shadetop[1]
-
-        left_buckle = False
-        right_buckle = False
-        for buckle in buckles:
-            buckle_center = ((buckle[0] + buckle[2]) / 2,
-                             (buckle[1] + buckle[3]) / 2)
-            if buckle_center[1] < shadetop[1] or buckle_center[1] > shadetop[3]:
-                continue
-            if buckle_center[0] < shadetop[0] or buckle_center[0] > shadetop[2]:
-                continue
-            if buckle_center[0] < shadetop_center[0]:
-                left_buckle = True
-            else:
-                right_buckle = True
-        if left_buckle and right_buckle:
-            break
-
-    return int(left_buckle) + int(right_buckle)
-
-
-def buckle_result(dets_for_class, update_count, frames_with_one_buckle,
-                  frames_with_two_buckles):
-    shadetops = dets_for_class[SHADETOP]
-    buckles = dets_for_class[BUCKLE]
-    if (len(shadetops) == 0) or (len(buckles) == 0):
-        return State.BUCKLE.result_wrapper_without_update(update_count)
-
-    status = gabriel_pb2.ResultWrapper.Status.SUCCESS
-    result_wrapper = cognitive_engine.create_result_wrapper(status)
-    n_buckles = _count_buckles(shadetops, buckles)
+    # Each matrix has a row for each shadetop and a column for each buckle
+    shadetop_centers = geometry.centers(shadetops)
+    buckle_centers = geometry.centers(buckles)
+    inside = geometry.contains(shadetops, buckle_centers)
+    left = geometry.less(shadetop_centers, buckle_centers, geometry.X)
+
+    left_buckle = (inside & left).any(axis=1)
+    right_buckle = (inside & ~left).any(axis=1)
+    if (left_buckle & right_buckle).any():
+        return 2
+
+    # Otherwise, the count comes from the last shadetop
+    return int(left_buckle[-1]) + int(right_buckle[-1])
+
+
+def _buckle_rule(step_rule, dets_for_class, old_state, client_info):
+    '''Move to the next state once both buckles have been seen on more than
+    FRAMES_WITH_TWO_BUCKLES_TO_ADVANCE frames in a row.'''
+    update_count = old_state.update_count
+    frames_with_one_buckle = old_state.frames_with_one_buckle
+    frames_with_two_buckles = old_state.frames_with_two_buckles
+
+    send_one_wire_instruction = False
+    n_buckles = _count_buckles(
+        dets_for_class[SHADETOP], dets_for_class[BUCKLE])
     if n_buckles == 2:
         frames_with_one_buckle = 0
         frames_with_two_buckles += 1
         update_count += 1
 
-        if frames_with_two_buckles > 3:
-            return State.BLACKCIRCLE.update_result_wrapper(update_count)
+        if frames_with_two_buckles > FRAMES_WITH_TWO_BUCKLES_TO_ADVANCE:
+            return step_rule.next_state.update_result_wrapper(
+                update_count, client_info)
     elif n_buckles == 1:
         frames_with_one_buckle += 1
         frames_with_two_buckles = 0
         update_count += 1
 
         # We only give this instruction when frames_with_one_buckle is
-        # exactly 5 so it does not get repeated
-        if frames_with_one_buckle == 5:
-            result = gabriel_pb2.ResultWrapper.Result()
-            result.payload_type = gabriel_pb2.PayloadType.TEXT
-            result.payload = ONE_WIRE_INSTRUCTION_BYTES
-            result_wrapper.results.append(result)
-
+        # exactly FRAMES_WITH_ONE_BUCKLE_FOR_INSTRUCTION so it does not get
+        # repeated
+        if frames_with_one_buckle == FRAMES_WITH_ONE_BUCKLE_FOR_INSTRUCTION:
+            send_one_wire_instruction = True
             logger.info('sending second wire message')
 
-    to_client_extras = ikea_pb2.ToClientExtras()
-    to_client_extras.state.update_count = update_count
-    to_client_extras.state.step = State.BUCKLE.get_proto_step()
-    to_client_extras.state.frames_with_one_buckle = frames_with_one_buckle
-    to_client_extras.state.frames_with_two_buckles = frames_with_two_buckles
-
-    result_wrapper.extras.Pack(to_client_extras)
+    result_wrapper = step_rule.state.result_wrapper_without_update(
+        update_count, frames_with_one_buckle, frames_with_two_buckles)
+    if send_one_wire_instruction:
+        result_wrapper.append_results(ONE_WIRE_INSTRUCTION)
     return result_wrapper
 
 
-def blackcircle_result(dets_for_class, update_count):
-    if len(dets_for_class[BLACKCIRCLE]) == 0:
-        return State.BLACKCIRCLE.result_wrapper_without_update(update_count)
-
-    return State.LAMP.update_result_wrapper(update_count + 1)
-
-
-def lamp_result(dets_for_class, update_count):
-    if len(dets_for_class[LAMP]) == 0:
-        return State.LAMP.result_wrapper_without_update(update_count)
-
-    return State.BULB.update_result_wrapper(update_count + 1)
-
-
-def bulb_result(dets_for_class, update_count):
-    if len(dets_for_class[BULB]) == 0:
-        return State.BULB.result_wrapper_without_update(update_count)
-
-    return State.BULBTOP.update_result_wrapper(update_count + 1)
-
-
-def bulbtop_result(dets_for_class, update_count):
+def _bulb_in_shade(dets_for_class):
     shadetops = dets_for_class[SHADETOP]
     bulbtops = dets_for_class[BULBTOP]
-    if (len(shadetops) == 0) or (len(bulbtops) == 0):
-        return State.BULBTOP.result_wrapper_without_update(update_count)
-
-    for shadetop in shadetops:
-        shadetop_center = ((shadetop[0] + shadetop[2]) / 2,
-                           (shadetop[1] + shadetop[3]) / 2)
-        shadetop_width = shadetop[2] - shadetop[0]
-        shadetop_height = shadetop[3] - shadetop[1]
-
-        for bulbtop in bulbtops:
-            bulbtop_center = ((bulbtop[0] + bulbtop[2]) / 2,
-                              (bulbtop[1] + bulbtop[3]) / 2)
-            if bulbtop_center[1] < shadetop[1] or (
-                    bulbtop_center[1] > shadetop[3]):
-                continue
-            if bulbtop_center[0] < shadetop[0] or (
-                    bulbtop_center[0] > shadetop[2]):
-                continue
-            if (bulbtop_center[0] < shadetop_center[0] -
-                shadetop_width * 0.25) or (
-                    bulbtop_center[0] > shadetop_center[0] +
-                    shadetop_width * 0.25):
-                continue
-            if (bulbtop_center[1] < shadetop_center[1] - shadetop_height *
-                0.25) or (bulbtop_center[1] > shadetop_center[1] +
-                          shadetop_height * 0.25):
-                continue
-
-            return State.DONE.update_result_wrapper(update_count + 1)
-
-    return State.BULBTOP.result_wrapper_without_update(update_count)
+
+    # Each matrix has a row for each shadetop and a column for each bulbtop
+    shadetop_centers = geometry.centers(shadetops)
+    bulbtop_centers = geometry.centers(bulbtops)
+    inside = geometry.contains(shadetops, bulbtop_centers)
+    centered_x = geometry.within_band(
+        shadetop_centers, geometry.widths(shadetops), 0.25, bulbtop_centers,
+        geometry.X)
+    centered_y = geometry.within_band(
+        shadetop_centers, geometry.heights(shadetops), 0.25, bulbtop_centers,
+        geometry.Y)
+
+    return (inside & centered_x & centered_y).any()
+
+
+class StepRule:
+    '''How a client leaves state.
+
+    classes are the classes that the rule reads. The engine only
+    post-processes detections for these classes. Until every one of them is
+    detected, the client stays in state and its counters are reset.
+
+    Once they are, rule is called with this StepRule, the detections, the
+    old ikea_pb2.State and the ClientInfo, and returns the ResultWrapper. The
+    default rule moves to next_state as soon as predicate returns True for
+    the detections. A predicate of None is always True.
+
+    If the rule only reads detections inside boxes of roi_class, the engine
+    can run the detector on a crop around where roi_class was last seen.
+
+    If classes can be found in frames with a long side of max_frame_wh
+    pixels, clients are asked to send frames of that size on state, and the
+    detector runs at that resolution. None uses the engine's default.'''
+
+    def __init__(self, state, classes, next_state, predicate=None,
+                 rule=_advance_rule, roi_class=None, max_frame_wh=None):
+        self.state = state
+        self.classes = classes
+        self.next_state = next_state
+        self.predicate = predicate
+        self.rule = rule
+        self.roi_class = roi_class
+        self.max_frame_wh = max_frame_wh
+
+    def result_wrapper(self, dets_for_class, old_state, client_info):
+        for cls_idx in self.classes:
+            if len(dets_for_class[cls_idx]) == 0:
+                return self.state.result_wrapper_without_update(
+                    old_state.update_count)
+
+        return self.rule(self, dets_for_class, old_state, client_info)
+
+
+# Steps that need the detector. Supporting a new task only takes new rows.
+# The base, shade and lamp fill much of the frame, so they are found at
+# half resolution.
+STEP_RULES = (
+    StepRule(State.BASE, (BASE,), State.PIPE, max_frame_wh=320),
+    StepRule(State.PIPE, (BASE, PIPE), State.SHADE, predicate=_pipe_on_base),
+    StepRule(State.SHADE, (SHADE,), State.BUCKLE, max_frame_wh=320),
+    StepRule(State.BUCKLE, (SHADETOP, BUCKLE), State.BLACKCIRCLE,
+             rule=_buckle_rule, roi_class=SHADETOP),
+    StepRule(State.BLACKCIRCLE, (BLACKCIRCLE,), State.LAMP),
+    StepRule(State.LAMP, (LAMP,), State.BULB, max_frame_wh=320),
+    StepRule(State.BULB, (BULB,), State.BULBTOP),
+    StepRule(State.BULBTOP, (SHADETOP, BULBTOP), State.DONE,
+             predicate=_bulb_in_shade, roi_class=SHADETOP),
+)
+
+
+def _compile(step_rules):
+    '''Return a list with the StepRule for each proto step at its index,
+    and None for steps without one.'''
+    dispatch = [None] * (max(ikea_pb2.State.Step.values()) + 1)
+    for step_rule in step_rules:
+        proto_step = step_rule.state.get_proto_step()
+        if dispatch[proto_step] is not None:
+            raise Exception('Two rules for {}'.format(step_rule.state.name))
+        dispatch[proto_step] = step_rule
+    return dispatch
+
+
+_dispatch = _compile(STEP_RULES)
+
+CLASSES_FOR_STEP = {
+    step_rule.state.get_proto_step(): step_rule.classes
+    for step_rule in STEP_RULES
+}
+
+ROI_CLASS_FOR_STEP = {
+    step_rule.state.get_proto_step(): step_rule.roi_class
+    for step_rule in STEP_RULES
+    if step_rule.roi_class is not None
+}
+
+MAX_FRAME_WH_FOR_STEP = {
+    step_rule.state.get_proto_step(): step_rule.max_frame_wh
+    for step_rule in STEP_RULES
+    if step_rule.max_frame_wh is not None
+}
+
+
+def result_wrapper(dets_for_class, old_state, client_info):
+    '''Return the ResultWrapper for a frame that was sent on old_state, an
+    ikea_pb2.State.'''
+    step_rule = None
+    if 0 <= old_state.step < len(_dispatch):
+        step_rule = _dispatch[old_state.step]
+    if step_rule is None:
+        raise Exception('Bad State')
+
+    return step_rule.result_wrapper(dets_for_class, old_state, client_info)
@@ -0,0 +1,310 @@
+from abc import ABC
+from abc import abstractmethod
+import os
+
+import cv2
+import numpy as np
+
+import box_utils
+
+
+# Every model directory has these files. Tasks that use the same directory
+# share one loaded network.
+MODEL_DIR = 'model'
+PROTOTXT_NAME = 'faster_rcnn_test.pt'
+CAFFEMODEL_NAME = 'model.caffemodel'
+
+CONF_THRESH = 0.5
+NMS_THRESH = 0.3
+
+# Defaults from py-faster-rcnn's fast_rcnn/config.py
+PIXEL_MEANS = np.array([[[102.9801, 115.9465, 122.7717]]], dtype=np.float32)
+TEST_SCALE = 600
+TEST_MAX_SIZE = 1000
+
+# Network inputs are padded at the bottom and right to the smallest of these
+# (height, width) shapes that they fit in. The network then only has to
+# reshape its buffers when the bucket changes, not whenever a frame has a
+# new size. Every whole frame fits in one of the full size buckets, because
+# get_img_scale keeps inputs within TEST_SCALE by TEST_MAX_SIZE, so frames
+# are never scaled differently than without padding. The half size buckets
+# are for crops, which are scaled like the frame they came from.
+FULL_INPUT_BUCKETS = (
+    (TEST_SCALE, TEST_SCALE * 4 // 3),
+    (TEST_SCALE * 4 // 3, TEST_SCALE),
+    (TEST_SCALE, TEST_MAX_SIZE),
+    (TEST_MAX_SIZE, TEST_SCALE),
+)
+INPUT_BUCKETS = tuple(
+    (height // 2, width // 2) for height, width in FULL_INPUT_BUCKETS
+) + FULL_INPUT_BUCKETS
+PAD_TO_BUCKETS = os.getenv('PAD_TO_BUCKETS', '1') == '1'
+
+CAFFE_GPU = 'caffe_gpu'
+OPENCV_CPU = 'opencv_cpu'
+
+# OPENCV_CPU with the network quantized to int8. See int8_report.py.
+OPENCV_CPU_INT8 = 'opencv_cpu_int8'
+
+BACKENDS = (CAFFE_GPU, OPENCV_CPU, OPENCV_CPU_INT8)
+
+# Backends whose networks still work in a process that was forked after
+# they were loaded. A CUDA context cannot be used after a fork.
+FORK_SAFE_BACKENDS = (OPENCV_CPU, OPENCV_CPU_INT8)
+
+
+def get_img_scale(height, width):
+    '''Return the factor that the network input is scaled by, for an image
+    of this size.'''
+    img_size_min = min(height, width)
+    img_size_max = max(height, width)
+    img_scale = float(TEST_SCALE) / float(img_size_min)
+    if np.round(img_scale * img_size_max) > TEST_MAX_SIZE:
+        img_scale = float(TEST_MAX_SIZE) / float(img_size_max)
+    return img_scale
+
+
+def get_input_bucket(height, width):
+    '''Return the smallest of INPUT_BUCKETS that a network input of this
+    size fits in.'''
+    fitting = [(bucket_height * bucket_width, (bucket_height, bucket_width))
+               for bucket_height, bucket_width in INPUT_BUCKETS
+               if bucket_height >= height and bucket_width >= width]
+    if len(fitting) == 0:
+        return height, width
+    return min(fitting)[1]
+
+
+def _buffer(buffers, name, shape):
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.float32)
+        buffers[name] = buffer
+    return buffer
+
+
+def get_blobs(img, buffers=None, pad_to_bucket=PAD_TO_BUCKETS,
+              img_scale=None):
+    '''Match _get_blobs from py-faster-rcnn's fast_rcnn/test.py
+
+    If buffers is a dict, the arrays in it are reused by later calls with
+    images of the same size. The data that is returned is then only valid
+    until the next call.
+
+    If pad_to_bucket is True, data is padded to its input bucket. The
+    padding is the mean pixel, which is zero after PIXEL_MEANS is
+    subtracted. im_info still has the size without padding, so that
+    proposals are clipped to the frame, and boxes scale back to the frame
+    the same way.
+
+    img is scaled by img_scale, which defaults to get_img_scale for its size.
+
+    Return (data, im_info, img_scale).'''
+    if buffers is None:
+        buffers = {}
+
+    img_orig = _buffer(buffers, 'img_orig', img.shape)
+    img_orig[...] = img
+    img_orig -= PIXEL_MEANS
+
+    if img_scale is None:
+        img_scale = get_img_scale(*img.shape[:2])
+    resized_shape = (int(np.round(img.shape[0] * img_scale)),
+                     int(np.round(img.shape[1] * img_scale)), img.shape[2])
+    resized = cv2.resize(
+        img_orig, None, _buffer(buffers, 'resized', resized_shape),
+        fx=img_scale, fy=img_scale, interpolation=cv2.INTER_LINEAR)
+
+    height, width = resized.shape[:2]
+    if pad_to_bucket:
+        data_height, data_width = get_input_bucket(height, width)
+    else:
+        data_height, data_width = height, width
+
+    data = _buffer(
+        buffers, 'data', (1, resized.shape[2], data_height, data_width))
+    data[0, :, :height, :width] = resized.transpose((2, 0, 1))
+    data[0, :, height:, :] = 0
+    data[0, :, :height, width:] = 0
+    im_info = np.array([[height, width, img_scale]], dtype=np.float32)
+    return data, im_info, img_scale
+
+
+class Detector(ABC):
+    def __init__(self):
+        # Arrays that get_blobs reuses for every frame
+        self._blob_buffers = {}
+
+    @abstractmethod
+    def _forward(self, img, img_scale):
+        '''Run the network on a BGR image, scaled by img_scale. An img_scale
+        of None uses get_img_scale.
+
+        Return (scores, boxes, box_deltas). boxes are the proposals from the
+        RPN, scaled back to the size of img. Boxes are not decoded here, so
+        that Detections only has to decode the ones it uses.'''
+        pass
+
+    def _forward_batch(self, imgs, img_scales):
+        '''Return a list with the output of _forward for each image.
+
+        The proposal layers in both backends only support batches with one
+        image, so this runs one forward pass per image. Backends with a
+        network that takes larger batches should override this.'''
+        return [self._forward(img, img_scale)
+                for img, img_scale in zip(imgs, img_scales)]
+
+    def detect(self, img, cls_idxs, img_scale=None):
+        '''Return Detections for the classes in cls_idxs. Class indexes
+        depend on the model, so they come from the rules of a task.
+
+        Nothing is post-processed until the Detections are first read.'''
+        return self.detect_batch([img], [cls_idxs], [img_scale])[0]
+
+    def detect_batch(self, imgs, cls_idxs_list, img_scales=None):
+        '''Return Detections for each image, for the classes in the matching
+        entry of cls_idxs_list.
+
+        Each image is scaled by the matching entry of img_scales, to run
+        crops at the scale of their frame. Images with an img_scale of None,
+        or all images if img_scales is None, use get_img_scale.'''
+        if img_scales is None:
+            img_scales = [None] * len(imgs)
+        outputs = self._forward_batch(imgs, img_scales)
+        return [
+            Detections(img.shape, scores, boxes, box_deltas, cls_idxs)
+            for img, (scores, boxes, box_deltas), cls_idxs in zip(
+                imgs, outputs, cls_idxs_list)
+        ]
+
+
+class Detections:
+    '''Detections for a set of classes, stored in a single array.
+
+    Each row is in [x1, y1, x2, y2, confidence, class index] format, and rows
+    are sorted by class index. Indexing with a class index returns the
+    [x1, y1, x2, y2, confidence] rows for that class, so this can be used in
+    place of a dict from class index to detections.
+
+    Boxes are decoded, thresholded and suppressed for all classes in cls_idxs
+    together, the first time that any of them are read.'''
+
+    def __init__(self, img_shape, scores, boxes, box_deltas, cls_idxs):
+        self._img_shape = img_shape
+        self._scores = scores
+        self._boxes = boxes
+        self._box_deltas = box_deltas
+        self._cls_idxs = np.array(sorted(cls_idxs), dtype=np.int64)
+        self._dets = None
+        self._class_starts = None
+
+    @classmethod
+    def from_array(cls, dets, cls_idxs):
+        '''Return Detections for rows that are already post-processed, such
+        as boxes that were tracked from an earlier frame.'''
+        detections = cls(None, None, None, None, cls_idxs)
+        detections._set_dets(dets)
+        return detections
+
+    def get_cls_idxs(self):
+        return self._cls_idxs
+
+    def _set_dets(self, dets):
+        self._dets = dets
+
+        # Models for other tasks can have a different number of classes
+        class_idx_limit = (
+            int(self._cls_idxs[-1]) + 1 if len(self._cls_idxs) > 0 else 0)
+        self._class_starts = np.searchsorted(
+            self._dets[:, 5], np.arange(class_idx_limit + 1))
+
+    def _postprocess(self):
+        self._set_dets(_postprocess(
+            self._img_shape, self._scores, self._boxes, self._box_deltas,
+            self._cls_idxs))
+
+        # Raw outputs are not needed anymore
+        self._scores = None
+        self._boxes = None
+        self._box_deltas = None
+
+    def __getitem__(self, cls_idx):
+        if cls_idx not in self._cls_idxs:
+            raise KeyError(cls_idx)
+        if self._dets is None:
+            self._postprocess()
+
+        start = self._class_starts[cls_idx]
+        end = self._class_starts[cls_idx + 1]
+        return self._dets[start:end, :5]
+
+    def get_array(self):
+        if self._dets is None:
+            self._postprocess()
+        return self._dets
+
+
+def _postprocess(img_shape, scores, boxes, box_deltas, cls_idxs):
+    # Every (proposal, class) pair that we drop here would also have been
+    # dropped after nms, because a box can only be suppressed by a box with a
+    # higher score. Only the pairs that are left get decoded.
+    roi_idxs, col_idxs = np.nonzero(scores[:, cls_idxs] >= CONF_THRESH)
+    det_cls_idxs = cls_idxs[col_idxs]
+
+    delta_cols = 4 * det_cls_idxs[:, np.newaxis] + np.arange(4)
+    pred_boxes = box_utils.bbox_transform_inv(
+        boxes[roi_idxs], box_deltas[roi_idxs[:, np.newaxis], delta_cols])
+    pred_boxes = box_utils.clip_boxes(pred_boxes, img_shape)
+
+    dets = np.empty((roi_idxs.shape[0], 6), dtype=np.float32)
+    dets[:, :4] = pred_boxes
+    dets[:, 4] = scores[roi_idxs, det_cls_idxs]
+    dets[:, 5] = det_cls_idxs
+
+    keep = box_utils.batched_nms(
+        dets[:, :4], dets[:, 4], det_cls_idxs, NMS_THRESH)
+    dets = dets[keep]
+
+    # A stable sort keeps the detections for each class in order of decreasing
+    # confidence
+    return dets[np.argsort(dets[:, 5], kind='stable')]
+
+
+def create_detector(backend, gpu_id=0, model_dir=MODEL_DIR):
+    caffemodel = os.path.join(model_dir, CAFFEMODEL_NAME)
+    if not os.path.isfile(caffemodel):
+        raise IOError(('{:s} not found.').format(caffemodel))
+
+    # Backends are imported here so that a node only needs the libraries for
+    # the backend that it actually runs
+    if backend == CAFFE_GPU:
+        from caffe_detector import CaffeDetector
+        return CaffeDetector(gpu_id, model_dir)
+    elif backend == OPENCV_CPU:
+        from opencv_detector import OpenCvDetector
+        return OpenCvDetector(model_dir)
+    elif backend == OPENCV_CPU_INT8:
+        from opencv_detector import QuantizedOpenCvDetector
+        return QuantizedOpenCvDetector(model_dir)
+
+    raise ValueError('Unknown detector backend: {}'.format(backend))
+
+
+class DetectorPool:
+    '''One detector for each model directory, so that tasks that use the
+    same model share one loaded network.'''
+
+    def __init__(self, backend, gpu_id=0):
+        self._backend = backend
+        self._gpu_id = gpu_id
+        self._detectors = {}
+
+    def get_backend(self):
+        return self._backend
+
+    def get(self, model_dir):
+        det = self._detectors.get(model_dir)
+        if det is None:
+            det = create_detector(self._backend, self._gpu_id, model_dir)
+            self._detectors[model_dir] = det
+        return det
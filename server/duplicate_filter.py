@@ -0,0 +1,79 @@
+'''Reuse detections for frames that are nearly the same as an earlier frame.
+
+Each session keeps the thumbnail of the last frame that went through the
+detector. A new frame from the same session, on the same step, reuses the
+detections of that frame if no pixel of its thumbnail differs from the stored
+thumbnail by more than max_diff. New frames are always compared with the
+frame that was run through the detector, so slow drift is not missed.
+Thumbnails come from thumbnails.gray_thumbnail.'''
+
+import logging
+
+import cv2
+
+from session_cache import SessionCache
+
+
+# Counts are logged each time this many frames have been checked
+LOG_INTERVAL = 1000
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Reference:
+    def __init__(self, step, img_shape, thumbnail, dets):
+        self.step = step
+        self.img_shape = img_shape
+        self.thumbnail = thumbnail
+        self.dets = dets
+        self.num_reused = 0
+
+
+class DuplicateFilter:
+    '''max_diff is in gray levels. Detections are reused for at most
+    max_reuse frames in a row, and a max_reuse of 0 turns this off.'''
+
+    def __init__(self, max_diff, max_reuse, max_sessions):
+        self._max_diff = max_diff
+        self._max_reuse = max_reuse
+        self._references = SessionCache(max_sessions)
+        self._num_hits = 0
+        self._num_misses = 0
+
+    def is_enabled(self):
+        return self._max_reuse > 0
+
+    def get_num_hits(self):
+        return self._num_hits
+
+    def get_num_misses(self):
+        return self._num_misses
+
+    def lookup(self, session_id, step, img, thumbnail):
+        '''Return the stored detections if img is a near duplicate of the
+        last frame that session_id sent to the detector, otherwise None.'''
+        reference = self._references.get(session_id)
+        hit = (
+            reference is not None and
+            reference.step == step and
+            reference.img_shape == img.shape and
+            reference.num_reused < self._max_reuse and
+            cv2.norm(thumbnail, reference.thumbnail, cv2.NORM_INF) <=
+            self._max_diff)
+
+        if hit:
+            reference.num_reused += 1
+            self._num_hits += 1
+        else:
+            self._num_misses += 1
+
+        if (self._num_hits + self._num_misses) % LOG_INTERVAL == 0:
+            logger.info('Duplicate frames: %d hits, %d misses',
+                        self._num_hits, self._num_misses)
+
+        return reference.dets if hit else None
+
+    def store(self, session_id, step, img, thumbnail, dets):
+        self._references.put(
+            session_id, _Reference(step, img.shape, thumbnail, dets))
@@ -0,0 +1,69 @@
+'''Vectorized geometry for detection rows in [x1, y1, x2, y2, ...] format.
+
+Functions that relate two sets of detections return a matrix with one row for
+each reference box and one column for each other box or point.'''
+
+import numpy as np
+
+
+X = 0
+Y = 1
+
+
+def centers(dets):
+    '''Return an (n, 2) array with the (x, y) center of each box.'''
+    return (dets[:, 0:2] + dets[:, 2:4]) / 2
+
+
+def widths(dets):
+    return dets[:, 2] - dets[:, 0]
+
+
+def heights(dets):
+    return dets[:, 3] - dets[:, 1]
+
+
+def contains(boxes, points):
+    '''Return whether each point is inside or on the edge of each box.'''
+    xs = points[:, X]
+    ys = points[:, Y]
+
+    # Written as negations so that this matches the rules it replaced for
+    # every input, including NaN
+    return (~(ys < boxes[:, 1, np.newaxis]) & ~(ys > boxes[:, 3, np.newaxis]) &
+            ~(xs < boxes[:, 0, np.newaxis]) & ~(xs > boxes[:, 2, np.newaxis]))
+
+
+def less(ref_points, points, axis):
+    '''Return whether each point is before each reference point on axis.
+
+    For axis X this means left of, and for axis Y this means above.'''
+    return points[:, axis] < ref_points[:, axis, np.newaxis]
+
+
+def greater(ref_points, points, axis):
+    '''Return whether each point is after each reference point on axis.'''
+    return points[:, axis] > ref_points[:, axis, np.newaxis]
+
+
+def within_band(ref_points, sizes, fraction, points, axis):
+    '''Return whether each point is within fraction * size of each reference
+    point on axis.
+
+    The band edges are computed in float64. On NumPy 1.x, the scalar
+    arithmetic that this replaced promoted float32 coordinates to float64
+    when they were multiplied by a Python float. NumPy 2 keeps them in
+    float32, so the dtype is set here to give the same answer for points
+    near an edge on both.'''
+    ref_coords = ref_points[:, axis].astype(np.float64)
+    margins = sizes.astype(np.float64) * fraction
+    lower = (ref_coords - margins)[:, np.newaxis]
+    upper = (ref_coords + margins)[:, np.newaxis]
+
+    coords = points[:, axis]
+    return ~(coords < lower) & ~(coords > upper)
+
+
+def ratios(ref_values, values):
+    '''Return values[j] / ref_values[i] for every pair.'''
+    return values / ref_values[:, np.newaxis]
@@ -1,6 +1,7 @@
 import asyncio
 import base64
 import credentials
+import functools
 import hashlib
 import hmac
 import logging
@@ -11,11 +12,16 @@ import aiohttp
 from aiohttp import web
 import aiohttp_jinja2
 import jinja2
+import message_bus
+import metrics
 
 
 ROLE = '1'
 USER_NAME = 'Human Expert'
 
+# Messages for an expert's browser are dropped once this many are waiting
+MAX_QUEUED_MESSAGES = 16
+
 
 logger = logging.getLogger(__name__)
 
@@ -49,70 +55,236 @@ def get_signature(meeting_number, key, role, secret):
     return signature.rstrip('=')
 
 
-class ServerState:
-    def __init__(self):
+class Session:
+    '''One client doing an assembly, and the expert helping them.'''
+
+    def __init__(self, session_id):
+        self._session_id = session_id
         self._state = None
-        self._user_connected = False
-
-    def create_websocket_handler(self, conn):
-        async def websocket_handler(request):
-            ws = web.WebSocketResponse()
-            await ws.prepare(request)
-            if self._user_connected:
-                logger.info('ignoring additional websocket connection')
-                return ws
-
-            self._user_connected = True
-            logger.info('websocket connection opened')
-
-            def engine_reader():
-                from_engine = conn.recv()
-                asyncio.ensure_future(ws.send_json(from_engine))
-                if from_engine.get('zoom_action') == 'start':
-                    self._state = from_engine.get('state')
-                elif from_engine.get('zoom_action') == 'stop':
-                    logger.info('Zoom call ended on state: %s', self._state)
-                    conn.send({ 'state': self._state })
-
-            asyncio.get_event_loop().add_reader(
-                conn.fileno(), engine_reader)
-
-            async for msg in ws:
-                if msg.type == aiohttp.WSMsgType.TEXT:
-                    self._state = msg.json().get('state')
-                    logger.info('Web user set state: %s', self._state)
-                elif msg.type == aiohttp.WSMsgType.ERROR:
-                    logger.error('ws connection closed with exception %s',
-                                 ws.exception())
-
-            self._user_connected = False
-            logger.info('websocket connection closed')
+        self._zoom_active = False
+        self._websocket = None
+        self._outgoing = asyncio.Queue(MAX_QUEUED_MESSAGES)
+
+    def get_session_id(self):
+        return self._session_id
+
+    def get_state(self):
+        return self._state
+
+    def set_state(self, state):
+        self._state = state
+
+    def get_zoom_active(self):
+        return self._zoom_active
+
+    def get_websocket(self):
+        return self._websocket
+
+    def get_num_queued(self):
+        '''Return the number of messages waiting to go to the expert.'''
+        return self._outgoing.qsize()
+
+    def set_websocket(self, websocket):
+        self._websocket = websocket
+        if websocket is None:
+            # Do not send old messages to the next expert that connects
+            self._outgoing = asyncio.Queue(MAX_QUEUED_MESSAGES)
+
+    def _send_to_websocket(self, message):
+        if self._websocket is None:
+            return
+        if self._outgoing.full():
+            logger.warning('Expert for session %s is not keeping up. '
+                           'Dropping message.', self._session_id)
+            return
+
+        self._outgoing.put_nowait(message)
+
+    async def send_loop(self, websocket):
+        '''Send queued messages to websocket, one at a time.'''
+        while True:
+            message = await self._outgoing.get()
+            await websocket.send_json(message)
+
+    def handle_from_engine(self, from_engine):
+        '''Return the reply for the engine, or None if it does not need one.'''
+        self._send_to_websocket(from_engine)
+
+        if from_engine.get('zoom_action') == 'start':
+            self._zoom_active = True
+            self._state = from_engine.get('state')
+            logger.info('Zoom call started for session %s on state: %s',
+                        self._session_id, self._state)
+        elif from_engine.get('zoom_action') == 'stop':
+            self._zoom_active = False
+            logger.info('Zoom call ended for session %s on state: %s',
+                        self._session_id, self._state)
+            return {'session_id': self._session_id, 'state': self._state}
+
+        return None
+
+
+class ServerState:
+    '''Registry of sessions, keyed by the session_id that clients send.'''
+
+    def __init__(self, num_workers):
+        self._sessions = {}
+        self._num_workers = num_workers
+
+        # Engine workers that have warmed up
+        self._ready_workers = set()
 
+        # The last metrics snapshot from each engine worker
+        self._engine_metrics = {}
+
+    def get_session(self, session_id):
+        return self._sessions.get(session_id)
+
+    def get_sessions(self):
+        return list(self._sessions.values())
+
+    def _remove_if_idle(self, session):
+        if (not session.get_zoom_active()) and (
+                session.get_websocket() is None):
+            self._sessions.pop(session.get_session_id(), None)
+
+    def handle_engine_message(self, worker_id, from_engine):
+        '''Return the reply for the engine, or None if it does not need one.'''
+        if 'metrics' in from_engine:
+            self._engine_metrics[worker_id] = from_engine['metrics']
+            return None
+        if from_engine.get('ready'):
+            logger.info('Engine worker %d is ready', worker_id)
+            self._ready_workers.add(worker_id)
+            return None
+
+        session_id = from_engine.get('session_id')
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = Session(session_id)
+            self._sessions[session_id] = session
+
+        reply = session.handle_from_engine(from_engine)
+        self._remove_if_idle(session)
+        return reply
+
+    def remove_worker(self, worker_id):
+        '''Called when an engine worker closes its message bus.'''
+        logger.warning('Engine worker %d is gone', worker_id)
+        self._ready_workers.discard(worker_id)
+
+    async def ready_handler(self, request):
+        '''Return 200 once every engine worker has warmed up, and 503 before
+        that, so that only warm replicas get clients.'''
+        num_ready = len(self._ready_workers)
+        return web.Response(
+            text='{} of {} engine workers ready\n'.format(
+                num_ready, self._num_workers),
+            status=200 if num_ready == self._num_workers else 503)
+
+    async def metrics_handler(self, request):
+        sessions = list(self._sessions.values())
+        gauges = [
+            ('ready_workers', {}, len(self._ready_workers)),
+            ('sessions', {}, len(sessions)),
+            ('websocket_sessions', {}, sum(
+                1 for session in sessions
+                if session.get_websocket() is not None)),
+            ('zoom_sessions', {}, sum(
+                1 for session in sessions if session.get_zoom_active())),
+            ('expert_queued_messages', {}, sum(
+                session.get_num_queued() for session in sessions)),
+        ]
+        return web.Response(
+            text=metrics.render(self._engine_metrics, gauges),
+            content_type='text/plain')
+
+    async def websocket_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        session_id = request.query.get('session')
+        session = self._sessions.get(session_id)
+        if session is None:
+            logger.info('websocket connection for unknown session: %s',
+                        session_id)
+            return ws
+        if session.get_websocket() is not None:
+            logger.info('ignoring additional websocket connection for '
+                        'session: %s', session_id)
             return ws
-        return websocket_handler
 
-    def get_user_connected(self):
-        return self._user_connected
+        session.set_websocket(ws)
+        logger.info('websocket connection opened for session: %s', session_id)
+
+        if session.get_zoom_active():
+            await ws.send_json({
+                'zoom_action': 'start',
+                'state': session.get_state(),
+            })
+        sender = asyncio.ensure_future(session.send_loop(ws))
+
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                session.set_state(msg.json().get('state'))
+                logger.info('Web user set state for session %s: %s',
+                            session_id, session.get_state())
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                logger.error('ws connection closed with exception %s',
+                             ws.exception())
+
+        sender.cancel()
+        session.set_websocket(None)
+        logger.info('websocket connection closed for session: %s', session_id)
+        self._remove_if_idle(session)
 
+        return ws
 
-def start_http_server(conn):
+
+def start_http_server(socks):
     app = web.Application()
     aiohttp_jinja2.setup(
         app, loader=jinja2.FileSystemLoader('templates'))
 
-    server_state = ServerState()
-    websocket_handler = server_state.create_websocket_handler(conn)
+    server_state = ServerState(len(socks))
+
+    async def start_engine_readers(app):
+        # Each engine worker has its own socket, so replies go back to the
+        # worker that asked
+        for worker_id, sock in enumerate(socks):
+            asyncio.ensure_future(serve_engine(worker_id, sock))
+
+    async def serve_engine(worker_id, sock):
+        await message_bus.serve(sock, functools.partial(
+            server_state.handle_engine_message, worker_id))
+        server_state.remove_worker(worker_id)
+
+    app.on_startup.append(start_engine_readers)
 
     @aiohttp_jinja2.template('index.html')
     async def index(request):
-        return { 'duplicate_connection': server_state.get_user_connected() }
+        return { 'sessions': server_state.get_sessions() }
+
+    @aiohttp_jinja2.template('session.html')
+    async def session(request):
+        session_id = request.match_info['session_id']
+        session = server_state.get_session(session_id)
+        return {
+            'session_id': session_id,
+            'unknown_session': session is None,
+            'duplicate_connection': (
+                session is not None and session.get_websocket() is not None),
+        }
 
     app.add_routes([
         web.get('/', index),
+        web.get('/session/{session_id}', session),
         web.get('/zoom', zoom),
         web.static('/static', 'static'),
         web.static('/images', 'images'),
-        web.get('/ws', websocket_handler),
+        web.get('/ws', server_state.websocket_handler),
+        web.get('/metrics', server_state.metrics_handler),
+        web.get('/ready', server_state.ready_handler),
     ])
 
     context = ssl.SSLContext()
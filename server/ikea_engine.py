@@ -1,134 +1,678 @@
-from multiprocessing import Process, Pipe
-import http_server
-
 import numpy as np
+import concurrent.futures
 import logging
 from gabriel_server import cognitive_engine
 from gabriel_protocol import gabriel_pb2
 import ikea_pb2
-import sys
 import os
+import time
 import cv2
-import credentials
-
-faster_rcnn_root = os.getenv('FASTER_RCNN_ROOT', '.')
-sys.path.append(os.path.join(faster_rcnn_root, "tools"))
-import _init_paths  # this is necessary
-from fast_rcnn.config import cfg as faster_rcnn_config
-from fast_rcnn.test import im_detect
-from fast_rcnn.nms_wrapper import nms
-sys.path.append(os.path.join(faster_rcnn_root, "python"))
-import caffe
+from backpressure import LoadLevel
+from box_tracker import BoxTracker
+import detector
+from duplicate_filter import DuplicateFilter
+import jpeg_header
+import message_bus
+import metrics
+from recording import Recorder
+import roi
+from session_cache import SessionCache
+from stage_timer import StageTimer
+import tasks
+import thumbnails
 
 import cv_rules
 
 
-PROTOTXT = 'model/faster_rcnn_test.pt'
-CAFFEMODEL = 'model/model.caffemodel'
-
-# Max image width and height
+# Max image width and height. Steps can ask clients for smaller frames. See
+# cv_rules.StepRule.
 IMAGE_MAX_WH = 640
 
-CONF_THRESH = 0.5
-NMS_THRESH = 0.3
 
-DUMMY_IMG_SIZE = (300, 500, 3)
+# A frame reuses the detections for an earlier frame from the same session if
+# no pixel of their thumbnails differs by more than DUPLICATE_MAX_DIFF gray
+# levels. Detections are reused for at most DUPLICATE_MAX_REUSE frames in a
+# row. Set DUPLICATE_MAX_REUSE to 0 to run every frame through the detector.
+DUPLICATE_MAX_DIFF = float(os.getenv('DUPLICATE_MAX_DIFF', '6'))
+DUPLICATE_MAX_REUSE = int(os.getenv('DUPLICATE_MAX_REUSE', '15'))
+
+# Run the detector on every TRACKING_INTERVAL-th frame from a session, and
+# track the boxes from that frame on the frames in between. The detector also
+# runs when tracking fails or the mean thumbnail difference from the last
+# detector frame is more than SCENE_CHANGE_DIFF gray levels. A
+# TRACKING_INTERVAL of 1 runs the detector on every frame.
+TRACKING_INTERVAL = int(os.getenv('TRACKING_INTERVAL', '1'))
+SCENE_CHANGE_DIFF = float(os.getenv('SCENE_CHANGE_DIFF', '10'))
+
+# Reduction factors that JPEGs can be decoded at, largest first
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# On steps that read only objects inside a parent box (see roi.py), once the
+# parent has been found with at least ROI_MIN_CONFIDENCE, later frames from
+# the session run the detector on a crop around it, grown by ROI_MARGIN of
+# its size on every side. The whole frame goes through the detector again
+# when a crop loses the parent, and after ROI_MAX_FRAMES crops in a row.
+# Crops are only used if their network input fits a smaller bucket than the
+# whole frame's. Set ROI_MAX_FRAMES to 0 to run the detector on whole frames
+# only.
+ROI_MARGIN = float(os.getenv('ROI_MARGIN', '0.25'))
+ROI_MIN_CONFIDENCE = float(os.getenv('ROI_MIN_CONFIDENCE', '0.7'))
+ROI_MAX_FRAMES = int(os.getenv('ROI_MAX_FRAMES', '30'))
+
+# One of detector.BACKENDS
+DETECTOR_BACKEND = os.getenv('DETECTOR_BACKEND', detector.CAFFE_GPU)
+
+# Tasks that every engine hosts. See tasks.load.
+TASKS = os.getenv('TASKS', 'ikea=cv_rules')
+
+# Seconds to wait for the HTTP server to say which step the expert picked
+ZOOM_STOP_TIMEOUT = float(os.getenv('ZOOM_STOP_TIMEOUT', '2'))
+
+# Max number of sessions whose step at the start of a Zoom call is remembered
+MAX_ZOOM_SESSIONS = 256
+
+# Max number of sessions whose cached image hashes are remembered
+MAX_CLIENT_CACHE_SESSIONS = 1024
+
+# Frames should get their result within TARGET_LATENCY_MS of reaching the
+# server, counting the time that they wait for a free engine. While they take
+# longer, clients are asked to send frames less often and at a lower JPEG
+# quality, one PACING_LEVELS step at a time. main.py also gives clients fewer
+# tokens. Set TARGET_LATENCY_MS to 0 to let clients send as fast as their
+# tokens allow.
+TARGET_LATENCY = float(os.getenv('TARGET_LATENCY_MS', '250')) / 1000
+
+# (max upload fps, JPEG quality) for each load level, from a node that keeps
+# up to a saturated one. 0 leaves the client's default.
+PACING_LEVELS = (
+    (0, 0),
+    (10, 70),
+    (5, 60),
+    (2, 50),
+)
+
+# Seconds between sending metrics to the HTTP server
+METRICS_PUSH_INTERVAL = 5
+
+# If RECORDING_DIR is set, every frame and its result are recorded to a new
+# directory in it. See recording.py. At most RECORDING_MAX_PENDING frames
+# wait to be written, and later frames are left out of the recording.
+RECORDING_DIR = os.getenv('RECORDING_DIR')
+RECORDING_SEGMENT_BYTES = int(
+    os.getenv('RECORDING_SEGMENT_BYTES', str(256 * 1024 * 1024)))
+RECORDING_MAX_PENDING = int(os.getenv('RECORDING_MAX_PENDING', '256'))
 
-CLASS_IDX_LIMIT = cv_rules.BULB + 1  # Bulb has the highest index
+logger = logging.getLogger(__name__)
 
-if not os.path.isfile(CAFFEMODEL):
-    raise IOError(('{:s} not found.').format(CAFFEMODEL))
 
+def load_tasks(detector_pool=None, startup_timer=None):
+    '''Return the tasks in TASKS, with their assets loaded.
 
-faster_rcnn_config.TEST.HAS_RPN = True  # Use RPN for proposals
+    If detector_pool is given, the detectors for the tasks are loaded into
+    it while the assets load. Both mostly run native code that releases the
+    GIL, so they overlap well. The time for each phase is added to
+    startup_timer, if it is given.'''
+    if startup_timer is None:
+        startup_timer = StageTimer()
 
-logger = logging.getLogger(__name__)
+    with startup_timer.measure('import'):
+        task_list = tasks.load(TASKS)
+
+    def load_assets():
+        with startup_timer.measure('assets'):
+            for task in task_list:
+                task.load_assets()
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        assets_loaded = executor.submit(load_assets)
+        if detector_pool is not None:
+            with startup_timer.measure('detectors'):
+                for task in task_list:
+                    detector_pool.get(task.get_model_dir())
+        assets_loaded.result()
+
+    return task_list
+
+
+def pacing_extras(level):
+    '''Return serialized ToClientExtras with the pacing for a load level.
+    Appending them to the value of packed ToClientExtras sets these fields,
+    because protobuf merges concatenated messages.'''
+    max_upload_fps, jpeg_quality = PACING_LEVELS[level]
+    return ikea_pb2.ToClientExtras(
+        max_upload_fps=max_upload_fps,
+        jpeg_quality=jpeg_quality).SerializeToString()
+
+
+class _PendingFrame:
+    '''A frame that is waiting for the detector.
+
+    det_img is the image that the detector runs on, scaled by img_scale. It
+    is a crop of img starting at roi_offset when the session has a region of
+    interest. An img_scale of None uses detector.get_img_scale.'''
 
+    def __init__(self, index, to_server_extras, task, client_info, img,
+                 thumbnail, img_scale):
+        self.index = index
+        self.to_server_extras = to_server_extras
+        self.task = task
+        self.client_info = client_info
+        self.img = img
+        self.thumbnail = thumbnail
+        self.det_img = img
+        self.img_scale = img_scale
+        self.roi_offset = None
 
-PROTO_TO_STATE = {state.get_proto_step(): state for state in cv_rules.State}
+    def use_whole_frame(self):
+        self.det_img = self.img
+        self.roi_offset = None
 
 
 class IkeaEngine(cognitive_engine.Engine):
-    def __init__(self):
-        http_server_conn, self._engine_conn = Pipe()
-        self._http_server_process = Process(
-            target=http_server.start_http_server,
-            args=(http_server_conn,))
-        self._http_server_process.start()
-
-        caffe.set_mode_gpu()
-
-        # 0 is the default GPU ID
-        caffe.set_device(0)
-        faster_rcnn_config.GPU_ID = 0
-
-        self.net = caffe.Net(PROTOTXT, CAFFEMODEL, caffe.TEST)
-        # Warmup on a dummy image
-        img = 128 * np.ones(DUMMY_IMG_SIZE, dtype=np.uint8)
-        for i in range(2):
-            _, _ = im_detect(self.net, img)
-        logger.info('Caffe net has been initilized')
-
-    def _detect_objects(self, img):
-        scores, boxes = im_detect(self.net, img)
-
-        dets_for_class = {}
-        # Start from 1 because 0 is the background
-        for cls_idx in range(1, CLASS_IDX_LIMIT):
-            cls_boxes = boxes[:, 4 * cls_idx : 4 * (cls_idx + 1)]
-            cls_scores = scores[:, cls_idx]
-
-            # dets: detected results, each line is in
-            #       [x1, y1, x2, y2, confidence] format
-            dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])).astype(
-                np.float32)
-
-            # non maximum suppression
-            keep = nms(dets, NMS_THRESH)
-            dets = dets[keep, :]
-
-            dets_for_class[cls_idx] = [
-                det for det in dets if det[-1] >= CONF_THRESH
-            ]
-
-        return dets_for_class
+    def __init__(self, engine_sock, gpu_id=0, det=None, task_list=None,
+                 detector_pool=None, startup_timer=None):
+        '''engine_sock is this engine's end of a message_bus socket pair.
+
+        task_list is a list of tasks.Task with their assets loaded, and
+        defaults to the tasks in TASKS. Detectors for the tasks come from
+        detector_pool, which defaults to a new pool for DETECTOR_BACKEND on
+        gpu_id. If det is given, it is used for every task instead.
+
+        startup_timer has the phases that loaded task_list and
+        detector_pool, if they were loaded before this engine. The phases
+        of this engine are added to it, and all of them are logged and
+        exported.
+
+        Once the detectors have been warmed up, the HTTP server is told that
+        this engine is ready.'''
+        start = time.perf_counter()
+        self._startup_timer = (
+            StageTimer() if startup_timer is None else startup_timer)
+        self._bus = message_bus.EngineBus(engine_sock)
+        self._stage_timer = StageTimer()
+        self._metrics = metrics.Registry()
+        self._last_metrics_push = time.monotonic()
+        self._input_queue_depth = 0
+        self._queue_wait = None
+
+        self._load_level = None
+        if TARGET_LATENCY > 0:
+            self._load_level = LoadLevel(len(PACING_LEVELS), TARGET_LATENCY)
+        self._pacing_extras = pacing_extras(0)
+
+        # The step that each session was on when its Zoom call started. This
+        # is used when the HTTP server does not reply in time.
+        self._zoom_start_states = SessionCache(MAX_ZOOM_SESSIONS)
+
+        # The image hashes that each session last reported, for frames that
+        # do not include them
+        self._cached_image_hashes = SessionCache(MAX_CLIENT_CACHE_SESSIONS)
+
+        self._duplicate_filter = DuplicateFilter(
+            DUPLICATE_MAX_DIFF, DUPLICATE_MAX_REUSE, MAX_CLIENT_CACHE_SESSIONS)
+        self._trackers = SessionCache(MAX_CLIENT_CACHE_SESSIONS)
+        self._regions = SessionCache(MAX_CLIENT_CACHE_SESSIONS)
+
+        self._recorder = None
+        if RECORDING_DIR:
+            self._recorder = Recorder(
+                RECORDING_DIR, RECORDING_SEGMENT_BYTES, RECORDING_MAX_PENDING)
+
+        if det is None and detector_pool is None:
+            detector_pool = detector.DetectorPool(DETECTOR_BACKEND, gpu_id)
+        if task_list is None:
+            task_list = load_tasks(
+                None if det is not None else detector_pool,
+                self._startup_timer)
+        self._tasks = {task.get_name(): task for task in task_list}
+        self._default_task = task_list[0]
+
+        # Detectors that load_tasks loaded are already in the pool
+        with self._startup_timer.measure('detectors'):
+            self._detectors = {
+                task.get_name(): (
+                    det if det is not None
+                    else detector_pool.get(task.get_model_dir()))
+                for task in task_list
+            }
+
+        # Run an input that exactly fills each bucket, so that no frame or
+        # crop is the first to reach a shape. The detections are never read,
+        # so no classes are asked for.
+        with self._startup_timer.measure('warmup'):
+            for task_detector in set(self._detectors.values()):
+                for shape in detector.INPUT_BUCKETS:
+                    task_detector.detect(
+                        np.full(shape + (3,), 128, dtype=np.uint8), (),
+                        img_scale=1.0)
+
+        self._startup_timer.record('total', time.perf_counter() - start)
+        logger.info('Engine is ready. Startup: %s', ', '.join(
+            '{} {:.2f} s'.format(phase, self._startup_timer.get_total(phase))
+            for phase in self._startup_timer.get_stages()))
+        for phase in self._startup_timer.get_stages():
+            self._metrics.set_gauge(
+                'startup_seconds', self._startup_timer.get_total(phase),
+                phase=phase)
+        self._bus.send({'ready': True})
+        self._push_metrics()
+
+    def get_startup_timer(self):
+        '''Return the StageTimer with the time spent in each phase of
+        starting this engine.'''
+        return self._startup_timer
+
+    def get_stage_timer(self):
+        '''Return the StageTimer with the time that frames spent in each
+        stage of handle_batch.'''
+        return self._stage_timer
+
+    def _detect_objects(self, pending):
+        '''Return Detections for each pending frame. Frames for tasks that
+        share a detector go through it as one batch.'''
+        batches = {}
+        for j, frame in enumerate(pending):
+            cls_idxs = frame.task.get_rules().CLASSES_FOR_STEP.get(
+                frame.to_server_extras.state.step)
+            if cls_idxs is None:
+                raise Exception('Bad State')
+            task_detector = self._detectors[frame.task.get_name()]
+            batches.setdefault(task_detector, []).append((j, frame, cls_idxs))
+
+        all_dets = [None] * len(pending)
+        for task_detector, batch in batches.items():
+            self._metrics.observe(
+                'detector_batch_size', len(batch), metrics.BATCH_SIZE_BUCKETS)
+            batch_dets = task_detector.detect_batch(
+                [frame.det_img for _, frame, _ in batch],
+                [cls_idxs for _, _, cls_idxs in batch],
+                [frame.img_scale for _, frame, _ in batch])
+            for (j, frame, _), dets_for_class in zip(batch, batch_dets):
+                if frame.roi_offset is not None:
+                    dets_for_class = detector.Detections.from_array(
+                        roi.shift(dets_for_class.get_array(),
+                                  *frame.roi_offset),
+                        dets_for_class.get_cls_idxs())
+                all_dets[j] = dets_for_class
+
+        return all_dets
+
+    def set_input_queue_depth(self, input_queue_depth):
+        '''Called by the scheduler with the number of frames that were
+        waiting when it sent a batch to this engine.'''
+        self._input_queue_depth = input_queue_depth
+
+    def set_queue_wait(self, queue_wait):
+        '''Called by the scheduler with the seconds that the oldest frame in
+        the next batch waited for this engine.'''
+        self._queue_wait = queue_wait
 
     def handle(self, input_frame):
-        to_server_extras = cognitive_engine.unpack_extras(
-            ikea_pb2.ToServerExtras, input_frame)
-        
+        return self.handle_batch([input_frame])[0]
+
+    def handle_batch(self, input_frames):
+        '''Process several InputFrames, running the detector on all of their
+        images together.
+
+        Return a ResultWrapper for each InputFrame, in the same order.'''
+        start = time.perf_counter()
+        result_wrappers, num_control_frames, control_seconds = (
+            self._handle_batch(input_frames))
+        elapsed = time.perf_counter() - start
+
+        # Every frame in a batch waits for the whole batch
+        for _ in input_frames:
+            self._stage_timer.record('frame', elapsed)
+            if self._queue_wait is not None:
+                self._stage_timer.record('queue', self._queue_wait)
+
+        # Frames that are answered without looking at their image, such as
+        # a Zoom STOP that waits for the HTTP server, say nothing about how
+        # long the detector takes. Their time is left out of the latency,
+        # and batches with only those frames are not observed.
+        if (self._load_level is not None and
+                num_control_frames < len(input_frames) and
+                self._load_level.observe(
+                    (self._queue_wait or 0) + elapsed - control_seconds)):
+            logger.info('Load level %d, latency_ms=%.1f',
+                        self._load_level.get(),
+                        self._load_level.get_latency() * 1000)
+            self._pacing_extras = pacing_extras(self._load_level.get())
+        if len(self._pacing_extras) > 0:
+            descriptor = ikea_pb2.ToClientExtras.DESCRIPTOR
+            for result_wrapper in result_wrappers:
+                if result_wrapper.extras.Is(descriptor):
+                    result_wrapper.extras.value += self._pacing_extras
+
+        if self._recorder is not None:
+            for input_frame, result_wrapper in zip(
+                    input_frames, result_wrappers):
+                self._recorder.record(input_frame, result_wrapper)
+
+        if time.monotonic() - self._last_metrics_push > METRICS_PUSH_INTERVAL:
+            self._push_metrics()
+
+        return result_wrappers
+
+    def _push_metrics(self):
+        '''Send totals to the HTTP server. This is the only I/O for metrics,
+        and it never blocks.'''
+        self._last_metrics_push = time.monotonic()
+        for stage in self._stage_timer.get_stages():
+            histogram = self._stage_timer.get_histogram(stage)
+            if stage == 'frame':
+                self._metrics.add_histogram('frame_seconds', histogram)
+            else:
+                self._metrics.add_histogram(
+                    'stage_seconds', histogram, stage=stage)
+
+        for name, task in self._tasks.items():
+            transition_counts = task.get_rules().get_transition_counts()
+            for state_name, count in transition_counts.items():
+                self._metrics.set_counter(
+                    'transitions_total', count, task=name, state=state_name)
+        self._metrics.set_counter(
+            'duplicate_frames_total', self._duplicate_filter.get_num_hits(),
+            result='hit')
+        self._metrics.set_counter(
+            'duplicate_frames_total', self._duplicate_filter.get_num_misses(),
+            result='miss')
+        if self._recorder is not None:
+            self._metrics.set_counter(
+                'recording_dropped_frames_total',
+                self._recorder.get_num_dropped())
+        self._metrics.set_gauge('input_queue_depth', self._input_queue_depth)
+        if self._load_level is not None:
+            self._metrics.set_gauge('load_level', self._load_level.get())
+        self._metrics.set_gauge(
+            'engine_bus_pending_messages', self._bus.get_num_pending())
+        self._metrics.set_counter(
+            'engine_bus_dropped_messages_total', self._bus.get_num_dropped())
+
+        self._bus.send({'metrics': self._metrics.snapshot()})
+
+    def _handle_batch(self, input_frames):
+        '''Return (result_wrappers, num_control_frames, control_seconds).
+        Control frames are answered without looking at their image, and
+        control_seconds is the time that they took.'''
+        result_wrappers = []
+        pending = []
+        num_control_frames = 0
+        control_seconds = 0.0
+        for input_frame in input_frames:
+            with self._stage_timer.measure('unpack'):
+                to_server_extras = cognitive_engine.unpack_extras(
+                    ikea_pb2.ToServerExtras, input_frame)
+            task = self._get_task(to_server_extras)
+            if task is None:
+                logger.info('Unknown task: %s', to_server_extras.task)
+                result_wrappers.append(cognitive_engine.create_result_wrapper(
+                    gabriel_pb2.ResultWrapper.Status.WRONG_INPUT_FORMAT))
+                num_control_frames += 1
+                continue
+
+            self._metrics.increment(
+                'frames_total', task=task.get_name(),
+                step=self._step_name(task, to_server_extras.state.step))
+            client_info = self._client_info(to_server_extras)
+            control_start = time.perf_counter()
+            result_wrapper = self._result_wrapper_without_cv(
+                input_frame, to_server_extras, task, client_info)
+            if result_wrapper is not None:
+                num_control_frames += 1
+                control_seconds += time.perf_counter() - control_start
+            else:
+                frame_scale = self._frame_scale(
+                    task, to_server_extras.state.step)
+                with self._stage_timer.measure('decode'):
+                    img = self._decode(input_frame, frame_scale)
+                if img is None:
+                    result_wrapper = cognitive_engine.create_result_wrapper(
+                        gabriel_pb2.ResultWrapper.Status.WRONG_INPUT_FORMAT)
+                else:
+                    thumbnail = self._thumbnail(to_server_extras, img)
+                    dets_for_class = self._find_duplicate(
+                        to_server_extras, img, thumbnail)
+                    if dets_for_class is None:
+                        dets_for_class = self._track(
+                            to_server_extras, task, img, thumbnail)
+                    if dets_for_class is None:
+                        pending.append(_PendingFrame(
+                            len(result_wrappers), to_server_extras, task,
+                            client_info, img, thumbnail,
+                            self._img_scale(img, frame_scale)))
+                    else:
+                        with self._stage_timer.measure('rules'):
+                            result_wrapper = task.get_rules().result_wrapper(
+                                dets_for_class, to_server_extras.state,
+                                client_info)
+            result_wrappers.append(result_wrapper)
+
+        if len(pending) == 0:
+            return result_wrappers, num_control_frames, control_seconds
+
+        for frame in pending:
+            self._use_roi(frame)
+        with self._stage_timer.measure('inference'):
+            all_dets = self._detect_objects(pending)
+
+            # Crops that lost the parent box go through the detector again,
+            # as whole frames
+            retry = [j for j, frame in enumerate(pending)
+                     if frame.roi_offset is not None and
+                     not self._roi_found(frame, all_dets[j])]
+            for j in retry:
+                pending[j].use_whole_frame()
+            if len(retry) > 0:
+                retry_dets = self._detect_objects([pending[j] for j in retry])
+                for j, dets_for_class in zip(retry, retry_dets):
+                    all_dets[j] = dets_for_class
+
+        for frame, dets_for_class in zip(pending, all_dets):
+            to_server_extras = frame.to_server_extras
+            # Detections are post-processed lazily. Doing it here does not
+            # add work, because the rules read every class they asked for.
+            with self._stage_timer.measure('postprocess'):
+                dets_for_class.get_array()
+
+            if self._duplicates_enabled(to_server_extras):
+                self._duplicate_filter.store(
+                    to_server_extras.session_id, to_server_extras.state.step,
+                    frame.img, frame.thumbnail, dets_for_class)
+            if self._tracking_enabled(to_server_extras):
+                self._trackers.put(to_server_extras.session_id, BoxTracker(
+                    to_server_extras.state.step, frame.img, frame.thumbnail,
+                    dets_for_class.get_array(), SCENE_CHANGE_DIFF))
+            self._update_roi(frame, dets_for_class)
+            with self._stage_timer.measure('rules'):
+                result_wrappers[frame.index] = (
+                    frame.task.get_rules().result_wrapper(
+                        dets_for_class, to_server_extras.state,
+                        frame.client_info))
+
+        return result_wrappers, num_control_frames, control_seconds
+
+    def _get_task(self, to_server_extras):
+        '''Return the Task that a frame is for, or None if this engine does
+        not host it.'''
+        if to_server_extras.task == '':
+            return self._default_task
+        return self._tasks.get(to_server_extras.task)
+
+    def _step_name(self, task, proto_step):
+        state = task.get_state(proto_step)
+        if state is not None:
+            return state.name
+        if proto_step in ikea_pb2.State.Step.values():
+            return ikea_pb2.State.Step.Name(proto_step)
+        return str(proto_step)
+
+    def _duplicates_enabled(self, to_server_extras):
+        # Frames without a session_id could come from different clients
+        return (self._duplicate_filter.is_enabled() and
+                to_server_extras.session_id != '')
+
+    def _tracking_enabled(self, to_server_extras):
+        return TRACKING_INTERVAL > 1 and to_server_extras.session_id != ''
+
+    def _thumbnail(self, to_server_extras, img):
+        '''Return the thumbnail of img, or None if neither the duplicate
+        filter nor the tracker looks at frames from this client. Both use
+        the same thumbnail.'''
+        if not (self._duplicates_enabled(to_server_extras) or
+                self._tracking_enabled(to_server_extras)):
+            return None
+        return thumbnails.gray_thumbnail(img)
+
+    def _find_duplicate(self, to_server_extras, img, thumbnail):
+        '''Return Detections for an earlier frame from the same session if
+        img is a near duplicate of it, otherwise None.'''
+        if not self._duplicates_enabled(to_server_extras):
+            return None
+
+        return self._duplicate_filter.lookup(
+            to_server_extras.session_id, to_server_extras.state.step, img,
+            thumbnail)
+
+    def _track(self, to_server_extras, task, img, thumbnail):
+        '''Return Detections tracked from the session's last detector frame,
+        or None if img has to go through the detector.'''
+        if not self._tracking_enabled(to_server_extras):
+            return None
+
+        step = to_server_extras.state.step
+        tracker = self._trackers.get(to_server_extras.session_id)
+        if (tracker is None or tracker.get_step() != step or
+                tracker.get_num_tracked() >= TRACKING_INTERVAL - 1):
+            return None
+
+        dets = tracker.track(img, thumbnail)
+        if dets is None:
+            return None
+
+        return detector.Detections.from_array(
+            dets, task.get_rules().CLASSES_FOR_STEP[step])
+
+    def _roi_class(self, frame):
+        '''Return the class to crop around for frame, or None if it always
+        goes through the detector whole.'''
+        if ROI_MAX_FRAMES == 0 or frame.to_server_extras.session_id == '':
+            return None
+        return frame.task.get_roi_class(frame.to_server_extras.state.step)
+
+    def _use_roi(self, frame):
+        '''Crop frame to its session's region of interest, if it has one.'''
+        if self._roi_class(frame) is None:
+            return
+
+        session_id = frame.to_server_extras.session_id
+        region = self._regions.get(session_id)
+        if region is None:
+            return
+        if (region.get_step() != frame.to_server_extras.state.step or
+                region.get_img_shape() != frame.img.shape or
+                region.get_num_used() >= ROI_MAX_FRAMES):
+            self._regions.pop(session_id)
+            return
+
+        # Crops are scaled like the whole frame
+        if frame.img_scale is None:
+            frame.img_scale = detector.get_img_scale(*frame.img.shape[:2])
+        frame.det_img = region.use(frame.img)
+        frame.roi_offset = region.get_crop()[:2]
+
+    def _roi_found(self, frame, dets_for_class):
+        '''Return True if the crop for frame still has the parent box.'''
+        found = roi.best_box(
+            dets_for_class[self._roi_class(frame)],
+            ROI_MIN_CONFIDENCE) is not None
+        self._metrics.increment(
+            'roi_frames_total', result='crop' if found else 'fallback')
+        if not found:
+            self._regions.pop(frame.to_server_extras.session_id)
+        return found
+
+    def _update_roi(self, frame, dets_for_class):
+        '''Move the session's region of interest to the parent box in
+        dets_for_class, or drop it if there is no confident parent.'''
+        roi_class = self._roi_class(frame)
+        if roi_class is None:
+            return
+
+        session_id = frame.to_server_extras.session_id
+        box = roi.best_box(dets_for_class[roi_class], ROI_MIN_CONFIDENCE)
+        if box is None:
+            self._regions.pop(session_id)
+            return
+
+        crop = roi.expand(box, ROI_MARGIN, frame.img.shape)
+        region = self._regions.get(session_id)
+        img_scale = frame.img_scale
+        if img_scale is None:
+            img_scale = detector.get_img_scale(*frame.img.shape[:2])
+        if not roi.saves_compute(crop, frame.img.shape, img_scale):
+            self._regions.pop(session_id)
+        elif frame.roi_offset is not None and region is not None:
+            region.move(crop)
+        else:
+            self._regions.put(session_id, roi.RegionOfInterest(
+                frame.to_server_extras.state.step, frame.img.shape, crop))
+
+    def _client_info(self, to_server_extras):
+        session_id = to_server_extras.session_id
+        if len(to_server_extras.cached_image_hashes) > 0:
+            cached_image_hashes = frozenset(
+                to_server_extras.cached_image_hashes)
+            # Frames without a session_id could come from different clients
+            if session_id != '':
+                self._cached_image_hashes.put(session_id, cached_image_hashes)
+        elif session_id == '':
+            cached_image_hashes = frozenset()
+        else:
+            cached_image_hashes = self._cached_image_hashes.get(
+                session_id, frozenset())
+
+        return cv_rules.ClientInfo(
+            to_server_extras.display, cached_image_hashes)
+
+    def _result_wrapper_without_cv(self, input_frame, to_server_extras, task,
+                                   client_info):
+        '''Return None if input_frame needs to be run through the detector.'''
         if (to_server_extras.zoom_status ==
               ikea_pb2.ToServerExtras.ZoomStatus.STOP):
-            msg = {
-                'zoom_action': 'stop'
-            }
-            self._engine_conn.send(msg)
-            pipe_output = self._engine_conn.recv()
-            new_state_name = pipe_output.get('state')
-            logger.info('Zoom Stopped. New state: %s', new_state_name)
-            state = cv_rules.State[new_state_name.upper()]
-            return state.update_result_wrapper(update_count=0)
-        
-
-        # When State contains a oneof field for different tasks, we can see if
-        # none have been set using to_server_extras.WhichOneof('')
-        
+            state = self._stop_zoom(to_server_extras.session_id, task)
+            return state.update_result_wrapper(
+                update_count=0, client_info=client_info)
+
         if to_server_extras.state.step == ikea_pb2.State.Step.DONE:
             status = gabriel_pb2.ResultWrapper.Status.SUCCESS
             return cognitive_engine.create_result_wrapper(status)
         elif to_server_extras.state.step == ikea_pb2.State.Step.START:
-            return cv_rules.State.BASE.update_result_wrapper(update_count=1)
+            return task.get_rules().FIRST_STATE.update_result_wrapper(
+                update_count=1, client_info=client_info)
 
-        state = PROTO_TO_STATE[to_server_extras.state.step]
+        state = task.get_state(to_server_extras.state.step)
+        if state is None:
+            raise Exception('Bad State')
         if (to_server_extras.zoom_status ==
             ikea_pb2.ToServerExtras.ZoomStatus.START):
             msg = {
                 'zoom_action': 'start',
-                'state': state.name.lower()
+                'state': state.name.lower(),
+                'session_id': to_server_extras.session_id,
             }
-            self._engine_conn.send(msg)
+            self._bus.send(msg)
+            self._zoom_start_states.put(to_server_extras.session_id, state)
             logger.info('Zoom Started')
 
+            # credentials.py is not checked in. It is only needed for Zoom
+            # calls, so tools such as benchmark_engine.py run without it.
+            import credentials
+
             status = gabriel_pb2.ResultWrapper.Status.SUCCESS
             result_wrapper = cognitive_engine.create_result_wrapper(status)
 
@@ -143,45 +687,92 @@ class IkeaEngine(cognitive_engine.Engine):
             result_wrapper.extras.Pack(to_client_extras)
             return result_wrapper
 
-        assert len(input_frame.payloads) == 1
-        if input_frame.payload_type != gabriel_pb2.PayloadType.IMAGE:
+        if (len(input_frame.payloads) != 1 or
+                input_frame.payload_type != gabriel_pb2.PayloadType.IMAGE):
             status = gabriel_pb2.ResultWrapper.Status.WRONG_INPUT_FORMAT
             return cognitive_engine.create_result_wrapper(status)
 
-        np_data = np.frombuffer(input_frame.payloads[0], dtype=np.uint8)
-        img = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
-        if max(img.shape) > IMAGE_MAX_WH:
-            raise Exception('Image too large')
-
-        return self._result_wrapper_from_cv(img, to_server_extras.state)
-
-    def _result_wrapper_from_cv(self, img, old_state):
-        dets_for_class = self._detect_objects(img)
-
-        update_count = old_state.update_count
-        old_step = old_state.step
-
-        if old_step == ikea_pb2.State.Step.BASE:
-            return cv_rules.base_result(dets_for_class, update_count)
-        elif old_step == ikea_pb2.State.Step.PIPE:
-            return cv_rules.pipe_result(dets_for_class, update_count)
-        elif old_step == ikea_pb2.State.Step.SHADE:
-            return cv_rules.shade_result(dets_for_class, update_count)
-        elif old_step == ikea_pb2.State.Step.BUCKLE:
-            frames_with_one_buckle = old_state.frames_with_one_buckle
-            frames_with_two_buckles = old_state.frames_with_two_buckles
-            return cv_rules.buckle_result(
-                dets_for_class, update_count, frames_with_one_buckle,
-                frames_with_two_buckles)
-        elif old_step == ikea_pb2.State.Step.BLACKCIRCLE:
-            return cv_rules.blackcircle_result(dets_for_class, update_count)
-        elif old_step == ikea_pb2.State.Step.LAMP:
-            return cv_rules.lamp_result(dets_for_class, update_count)
-        elif old_step == ikea_pb2.State.Step.BULB:
-            return cv_rules.bulb_result(dets_for_class, update_count)
-        elif old_step == ikea_pb2.State.Step.BULBTOP:
-            return cv_rules.bulbtop_result(dets_for_class, update_count)
-        elif old_step == ikea_pb2.State.Step.DONE:
-            return cv_rules.done_result(dets_for_class, update_count)
-        else:
-            raise Exception('Bad State')
+        return None
+
+    def _stop_zoom(self, session_id, task):
+        '''Return the State of task that the expert picked for session_id.
+
+        Fall back to the step that the session was on when the call started,
+        if the HTTP server does not reply in time.'''
+        fallback = self._zoom_start_states.pop(
+            session_id, task.get_rules().FIRST_STATE)
+        msg = {
+            'zoom_action': 'stop',
+            'session_id': session_id,
+        }
+        reply = self._bus.request(msg, ZOOM_STOP_TIMEOUT)
+
+        new_state_name = None if reply is None else reply.get('state')
+        if new_state_name is None:
+            logger.warning(
+                'No state from HTTP server for session %s. Using %s',
+                session_id, fallback.name.lower())
+            return fallback
+
+        logger.info('Zoom Stopped. New state: %s', new_state_name)
+        return task.get_rules().State[new_state_name.upper()]
+
+    def _frame_scale(self, task, proto_step):
+        '''Return the factor that the detector input for frames on
+        proto_step is scaled by, on top of detector.get_img_scale.
+
+        Steps that ask for frames smaller than IMAGE_MAX_WH run through the
+        detector at that much lower resolution, whatever size the client
+        actually sent.'''
+        max_frame_wh = task.get_max_frame_wh(proto_step)
+        if max_frame_wh is None or max_frame_wh >= IMAGE_MAX_WH:
+            return 1.0
+        return max_frame_wh / IMAGE_MAX_WH
+
+    def _img_scale(self, img, frame_scale):
+        '''Return the img_scale for the detector, or None to use its
+        default.'''
+        if frame_scale == 1.0:
+            return None
+        return detector.get_img_scale(*img.shape[:2]) * frame_scale
+
+    def _decode(self, input_frame, frame_scale=1.0):
+        '''Return the image in input_frame, or None if it is too large or it
+        could not be decoded.
+
+        JPEGs are checked before they are decoded. If the detector would
+        scale an image down by at least half, after frame_scale, the image is
+        decoded at a reduced size.'''
+        data = input_frame.payloads[0]
+        if len(data) == 0:
+            logger.info('Empty image')
+            return None
+
+        size = jpeg_header.get_size(data)
+        if size is not None and max(size) > IMAGE_MAX_WH:
+            logger.info('Rejecting %dx%d image', size[1], size[0])
+            return None
+
+        flags = cv2.IMREAD_COLOR
+        if size is not None:
+            img_scale = detector.get_img_scale(*size) * frame_scale
+            for factor, reduced_flags in REDUCED_DECODE_FLAGS:
+                # The reduced image is never smaller than the network input
+                if img_scale * factor <= 1:
+                    flags = reduced_flags
+                    break
+
+        try:
+            img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+        except cv2.error:
+            img = None
+        if img is None:
+            logger.info('Could not decode image')
+            return None
+
+        # Sizes of images that are not JPEGs are only known after decoding
+        if max(img.shape[:2]) > IMAGE_MAX_WH:
+            logger.info('Rejecting %dx%d image', img.shape[1], img.shape[0])
+            return None
+
+        return img
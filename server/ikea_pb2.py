@@ -20,7 +20,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   package='ikea',
   syntax='proto3',
   serialized_options=_b('\n\017edu.cmu.cs.ikeaB\006Protos'),
-  serialized_pb=_b('\n\nikea.proto\x12\x04ikea\"\xf8\x01\n\x05State\x12\x14\n\x0cupdate_count\x18\x01 \x01(\x03\x12\x1e\n\x04step\x18\x02 \x01(\x0e\x32\x10.ikea.State.Step\x12\x1e\n\x16\x66rames_with_one_buckle\x18\x03 \x01(\x05\x12\x1f\n\x17\x66rames_with_two_buckles\x18\x04 \x01(\x05\"x\n\x04Step\x12\t\n\x05START\x10\x00\x12\x08\n\x04\x42\x41SE\x10\x01\x12\x08\n\x04PIPE\x10\x02\x12\t\n\x05SHADE\x10\x03\x12\n\n\x06\x42UCKLE\x10\x04\x12\x0f\n\x0b\x42LACKCIRCLE\x10\x06\x12\x08\n\x04LAMP\x10\x07\x12\x08\n\x04\x42ULB\x10\x08\x12\x0b\n\x07\x42ULBTOP\x10\t\x12\x08\n\x04\x44ONE\x10\n\"\x92\x01\n\x0eToServerExtras\x12\x34\n\x0bzoom_status\x18\x01 \x01(\x0e\x32\x1f.ikea.ToServerExtras.ZoomStatus\x12\x1a\n\x05state\x18\x02 \x01(\x0b\x32\x0b.ikea.State\".\n\nZoomStatus\x12\x0b\n\x07NO_CALL\x10\x00\x12\t\n\x05START\x10\x01\x12\x08\n\x04STOP\x10\x02\"\xdb\x01\n\x0eToClientExtras\x12\x32\n\tzoom_info\x18\x01 \x01(\x0b\x32\x1d.ikea.ToClientExtras.ZoomInfoH\x00\x12\x1c\n\x05state\x18\x02 \x01(\x0b\x32\x0b.ikea.StateH\x00\x1a\x61\n\x08ZoomInfo\x12\x0f\n\x07\x61pp_key\x18\x01 \x01(\t\x12\x12\n\napp_secret\x18\x02 \x01(\t\x12\x16\n\x0emeeting_number\x18\x03 \x01(\t\x12\x18\n\x10meeting_password\x18\x04 \x01(\tB\x14\n\x12zoom_info_or_stateB\x19\n\x0f\x65\x64u.cmu.cs.ikeaB\x06Protosb\x06proto3')
+  serialized_pb=_b('\n\nikea.proto\x12\x04ikea\"\xf8\x01\n\x05State\x12\x14\n\x0cupdate_count\x18\x01 \x01(\x03\x12\x1e\n\x04step\x18\x02 \x01(\x0e\x32\x10.ikea.State.Step\x12\x1e\n\x16\x66rames_with_one_buckle\x18\x03 \x01(\x05\x12\x1f\n\x17\x66rames_with_two_buckles\x18\x04 \x01(\x05\"x\n\x04Step\x12\t\n\x05START\x10\x00\x12\x08\n\x04\x42\x41SE\x10\x01\x12\x08\n\x04PIPE\x10\x02\x12\t\n\x05SHADE\x10\x03\x12\n\n\x06\x42UCKLE\x10\x04\x12\x0f\n\x0b\x42LACKCIRCLE\x10\x06\x12\x08\n\x04LAMP\x10\x07\x12\x08\n\x04\x42ULB\x10\x08\x12\x0b\n\x07\x42ULBTOP\x10\t\x12\x08\n\x04\x44ONE\x10\n\"\x86\x01\n\x07\x44isplay\x12\r\n\x05width\x18\x01 \x01(\x05\x12\x0e\n\x06height\x18\x02 \x01(\x05\x12\x30\n\rimage_formats\x18\x03 \x03(\x0e\x32\x19.ikea.Display.ImageFormat\"*\n\x0bImageFormat\x12\x07\n\x03PNG\x10\x00\x12\x08\n\x04JPEG\x10\x01\x12\x08\n\x04WEBP\x10\x02\"\xf1\x01\n\x0eToServerExtras\x12\x34\n\x0bzoom_status\x18\x01 \x01(\x0e\x32\x1f.ikea.ToServerExtras.ZoomStatus\x12\x1a\n\x05state\x18\x02 \x01(\x0b\x32\x0b.ikea.State\x12\x12\n\nsession_id\x18\x03 \x01(\t\x12\x1e\n\x07\x64isplay\x18\x04 \x01(\x0b\x32\r.ikea.Display\x12\x1b\n\x13\x63\x61\x63hed_image_hashes\x18\x05 \x03(\t\x12\x0c\n\x04task\x18\x06 \x01(\t\".\n\nZoomStatus\x12\x0b\n\x07NO_CALL\x10\x00\x12\t\n\x05START\x10\x01\x12\x08\n\x04STOP\x10\x02\"\xb3\x02\n\x0eToClientExtras\x12\x32\n\tzoom_info\x18\x01 \x01(\x0b\x32\x1d.ikea.ToClientExtras.ZoomInfoH\x00\x12\x1c\n\x05state\x18\x02 \x01(\x0b\x32\x0b.ikea.StateH\x00\x12\x12\n\nimage_hash\x18\x03 \x01(\t\x12\x14\n\x0cmax_frame_wh\x18\x04 \x01(\x05\x12\x16\n\x0emax_upload_fps\x18\x05 \x01(\x05\x12\x14\n\x0cjpeg_quality\x18\x06 \x01(\x05\x1a\x61\n\x08ZoomInfo\x12\x0f\n\x07\x61pp_key\x18\x01 \x01(\t\x12\x12\n\napp_secret\x18\x02 \x01(\t\x12\x16\n\x0emeeting_number\x18\x03 \x01(\t\x12\x18\n\x10meeting_password\x18\x04 \x01(\tB\x14\n\x12zoom_info_or_stateB\x19\n\x0f\x65\x64u.cmu.cs.ikeaB\x06Protosb\x06proto3')
 )
 
 
@@ -79,6 +79,32 @@ _STATE_STEP = _descriptor.EnumDescriptor(
 )
 _sym_db.RegisterEnumDescriptor(_STATE_STEP)
 
+_DISPLAY_IMAGEFORMAT = _descriptor.EnumDescriptor(
+  name='ImageFormat',
+  full_name='ikea.Display.ImageFormat',
+  filename=None,
+  file=DESCRIPTOR,
+  values=[
+    _descriptor.EnumValueDescriptor(
+      name='PNG', index=0, number=0,
+      serialized_options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='JPEG', index=1, number=1,
+      serialized_options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='WEBP', index=2, number=2,
+      serialized_options=None,
+      type=None),
+  ],
+  containing_type=None,
+  serialized_options=None,
+  serialized_start=364,
+  serialized_end=406,
+)
+_sym_db.RegisterEnumDescriptor(_DISPLAY_IMAGEFORMAT)
+
 _TOSERVEREXTRAS_ZOOMSTATUS = _descriptor.EnumDescriptor(
   name='ZoomStatus',
   full_name='ikea.ToServerExtras.ZoomStatus',
@@ -100,8 +126,8 @@ _TOSERVEREXTRAS_ZOOMSTATUS = _descriptor.EnumDescriptor(
   ],
   containing_type=None,
   serialized_options=None,
-  serialized_start=372,
-  serialized_end=418,
+  serialized_start=604,
+  serialized_end=650,
 )
 _sym_db.RegisterEnumDescriptor(_TOSERVEREXTRAS_ZOOMSTATUS)
 
@@ -159,6 +185,52 @@ _STATE = _descriptor.Descriptor(
 )
 
 
+_DISPLAY = _descriptor.Descriptor(
+  name='Display',
+  full_name='ikea.Display',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='width', full_name='ikea.Display.width', index=0,
+      number=1, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='height', full_name='ikea.Display.height', index=1,
+      number=2, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='image_formats', full_name='ikea.Display.image_formats', index=2,
+      number=3, type=14, cpp_type=8, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+    _DISPLAY_IMAGEFORMAT,
+  ],
+  serialized_options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=272,
+  serialized_end=406,
+)
+
+
 _TOSERVEREXTRAS = _descriptor.Descriptor(
   name='ToServerExtras',
   full_name='ikea.ToServerExtras',
@@ -180,6 +252,34 @@ _TOSERVEREXTRAS = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='session_id', full_name='ikea.ToServerExtras.session_id', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='display', full_name='ikea.ToServerExtras.display', index=3,
+      number=4, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='cached_image_hashes', full_name='ikea.ToServerExtras.cached_image_hashes', index=4,
+      number=5, type=9, cpp_type=9, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='task', full_name='ikea.ToServerExtras.task', index=5,
+      number=6, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
   ],
   extensions=[
   ],
@@ -193,8 +293,8 @@ _TOSERVEREXTRAS = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=272,
-  serialized_end=418,
+  serialized_start=409,
+  serialized_end=650,
 )
 
 
@@ -245,8 +345,8 @@ _TOCLIENTEXTRAS_ZOOMINFO = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=521,
-  serialized_end=618,
+  serialized_start=841,
+  serialized_end=938,
 )
 
 _TOCLIENTEXTRAS = _descriptor.Descriptor(
@@ -270,6 +370,34 @@ _TOCLIENTEXTRAS = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='image_hash', full_name='ikea.ToClientExtras.image_hash', index=2,
+      number=3, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='max_frame_wh', full_name='ikea.ToClientExtras.max_frame_wh', index=3,
+      number=4, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='max_upload_fps', full_name='ikea.ToClientExtras.max_upload_fps', index=4,
+      number=5, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='jpeg_quality', full_name='ikea.ToClientExtras.jpeg_quality', index=5,
+      number=6, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      serialized_options=None, file=DESCRIPTOR),
   ],
   extensions=[
   ],
@@ -285,14 +413,17 @@ _TOCLIENTEXTRAS = _descriptor.Descriptor(
       name='zoom_info_or_state', full_name='ikea.ToClientExtras.zoom_info_or_state',
       index=0, containing_type=None, fields=[]),
   ],
-  serialized_start=421,
-  serialized_end=640,
+  serialized_start=653,
+  serialized_end=960,
 )
 
 _STATE.fields_by_name['step'].enum_type = _STATE_STEP
 _STATE_STEP.containing_type = _STATE
+_DISPLAY.fields_by_name['image_formats'].enum_type = _DISPLAY_IMAGEFORMAT
+_DISPLAY_IMAGEFORMAT.containing_type = _DISPLAY
 _TOSERVEREXTRAS.fields_by_name['zoom_status'].enum_type = _TOSERVEREXTRAS_ZOOMSTATUS
 _TOSERVEREXTRAS.fields_by_name['state'].message_type = _STATE
+_TOSERVEREXTRAS.fields_by_name['display'].message_type = _DISPLAY
 _TOSERVEREXTRAS_ZOOMSTATUS.containing_type = _TOSERVEREXTRAS
 _TOCLIENTEXTRAS_ZOOMINFO.containing_type = _TOCLIENTEXTRAS
 _TOCLIENTEXTRAS.fields_by_name['zoom_info'].message_type = _TOCLIENTEXTRAS_ZOOMINFO
@@ -304,6 +435,7 @@ _TOCLIENTEXTRAS.oneofs_by_name['zoom_info_or_state'].fields.append(
   _TOCLIENTEXTRAS.fields_by_name['state'])
 _TOCLIENTEXTRAS.fields_by_name['state'].containing_oneof = _TOCLIENTEXTRAS.oneofs_by_name['zoom_info_or_state']
 DESCRIPTOR.message_types_by_name['State'] = _STATE
+DESCRIPTOR.message_types_by_name['Display'] = _DISPLAY
 DESCRIPTOR.message_types_by_name['ToServerExtras'] = _TOSERVEREXTRAS
 DESCRIPTOR.message_types_by_name['ToClientExtras'] = _TOCLIENTEXTRAS
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
@@ -315,6 +447,13 @@ State = _reflection.GeneratedProtocolMessageType('State', (_message.Message,), {
   })
 _sym_db.RegisterMessage(State)
 
+Display = _reflection.GeneratedProtocolMessageType('Display', (_message.Message,), {
+  'DESCRIPTOR' : _DISPLAY,
+  '__module__' : 'ikea_pb2'
+  # @@protoc_insertion_point(class_scope:ikea.Display)
+  })
+_sym_db.RegisterMessage(Display)
+
 ToServerExtras = _reflection.GeneratedProtocolMessageType('ToServerExtras', (_message.Message,), {
   'DESCRIPTOR' : _TOSERVEREXTRAS,
   '__module__' : 'ikea_pb2'
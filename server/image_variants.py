@@ -0,0 +1,83 @@
+'''Smaller copies of the instruction images, for clients that can use them.
+
+Each image is encoded in every format at its original width, and at every
+width in WIDTHS that is smaller than the original. The original PNG is always
+kept as is, and it is what clients that do not send a Display get.'''
+
+import hashlib
+
+import cv2
+import numpy as np
+
+import ikea_pb2
+
+
+WIDTHS = (360, 720, 1080)
+
+PNG = ikea_pb2.Display.ImageFormat.PNG
+JPEG = ikea_pb2.Display.ImageFormat.JPEG
+WEBP = ikea_pb2.Display.ImageFormat.WEBP
+
+ENCODINGS = {
+    PNG: ('.png', []),
+    JPEG: ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 85]),
+    WEBP: ('.webp', [cv2.IMWRITE_WEBP_QUALITY, 80]),
+}
+
+
+def _encode(img, image_format):
+    ext, params = ENCODINGS[image_format]
+    success, encoded = cv2.imencode(ext, img, params)
+    if not success:
+        raise Exception('Could not encode image as {}'.format(ext))
+
+    return encoded.tobytes()
+
+
+def make_variants(png_bytes):
+    '''Return a dict from (image format, width) to encoded image.'''
+    # The instruction images are opaque, so the alpha channel is dropped
+    img = cv2.imdecode(np.frombuffer(png_bytes, dtype=np.uint8),
+                       cv2.IMREAD_COLOR)
+    height, original_width = img.shape[:2]
+
+    variants = {(PNG, original_width): png_bytes}
+    for image_format in (JPEG, WEBP):
+        variants[(image_format, original_width)] = _encode(img, image_format)
+
+    for width in WIDTHS:
+        if width >= original_width:
+            continue
+
+        resized = cv2.resize(
+            img, (width, round(height * width / original_width)),
+            interpolation=cv2.INTER_AREA)
+        for image_format in ENCODINGS:
+            variants[(image_format, width)] = _encode(resized, image_format)
+
+    return variants
+
+
+def content_hash(image_bytes):
+    '''Return a short hex digest that identifies image_bytes.'''
+    return hashlib.sha256(image_bytes).hexdigest()[:16]
+
+
+def select(variants, display):
+    '''Return the key of the smallest variant that display can show without
+    scaling it up.
+
+    If no variant is as wide as the display, the widest ones are used.'''
+    image_formats = set(display.image_formats)
+    image_formats.add(PNG)
+    keys = [key for key in variants if key[0] in image_formats]
+
+    widths = [width for _, width in keys]
+    wide_enough = [width for width in widths if width >= display.width]
+    if display.width > 0 and len(wide_enough) > 0:
+        width = min(wide_enough)
+    else:
+        width = max(widths)
+
+    return min((key for key in keys if key[1] == width),
+               key=lambda key: len(variants[key]))
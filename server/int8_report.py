@@ -0,0 +1,199 @@
+'''Calibrate the int8 detector on recorded frames, and compare it with the
+float detector.
+
+With --calibrate, the inputs that QuantizedOpenCvDetector calibrates on are
+written to the model directory. They are the inputs for one frame, picked
+from the first frames of a recording, because the Proposal layer only takes
+one image per forward pass and OpenCV takes the quantization ranges from a
+single pass. The report then runs opencv_cpu and opencv_cpu_int8 on the
+same recorded frames. For each class, it counts the frames where the number
+of detections differs. It also runs cv_rules on both outputs, and counts the
+frames where the client would end up in a different state. Only use the int8
+detector where the states match.
+
+Frames that were used for calibration should be left out of the report with
+--skip. Run from the server directory, e.g.:
+    python3 int8_report.py --recording rec/ --calibrate --num-frames 8
+    python3 int8_report.py --recording rec/ --skip 8 --num-frames 500
+'''
+
+import argparse
+import collections
+import logging
+import os
+import time
+
+import cv2
+import numpy as np
+
+import cv_rules
+import detector
+import ikea_pb2
+import opencv_detector
+from recording import RecordingReader
+
+
+CLASS_NAMES = {
+    cv_rules.SHADETOP: 'shadetop',
+    cv_rules.BULBTOP: 'bulbtop',
+    cv_rules.BUCKLE: 'buckle',
+    cv_rules.LAMP: 'lamp',
+    cv_rules.PIPE: 'pipe',
+    cv_rules.BLACKCIRCLE: 'blackcircle',
+    cv_rules.BASE: 'base',
+    cv_rules.SHADE: 'shade',
+    cv_rules.BULB: 'bulb',
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_frames(recording_dir, skip, num_frames):
+    '''Return (img, ToServerExtras) for recorded frames on steps that need
+    the detector, starting at record skip. A num_frames of 0 loads every
+    frame.'''
+    reader = RecordingReader(recording_dir)
+    frames = []
+    for i in range(skip, len(reader)):
+        if len(frames) == num_frames > 0:
+            break
+
+        record = reader[i]
+        if record.step not in cv_rules.CLASSES_FOR_STEP:
+            continue
+        img = cv2.imdecode(
+            np.frombuffer(record.payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        frames.append((img, record.get_to_server_extras()))
+
+    return frames
+
+
+def calibrate(frames, model_dir):
+    '''Write the network inputs for one frame. The frame is the middle one
+    of the frames in the most common input bucket.'''
+    blobs = [detector.get_blobs(img, pad_to_bucket=True)[:2]
+             for img, _ in frames]
+    shape = collections.Counter(
+        data.shape for data, _ in blobs).most_common(1)[0][0]
+    chosen = [(data, im_info) for data, im_info in blobs
+              if data.shape == shape]
+    data, im_info = chosen[len(chosen) // 2]
+
+    path = os.path.join(model_dir, opencv_detector.CALIBRATION_NAME)
+    np.savez(path, data=data, im_info=im_info)
+    print('Wrote 1 calibration frame with input shape {}x{} to {}. {} of {} '
+          'frames had this shape.'.format(
+              shape[2], shape[3], path, len(chosen), len(frames)))
+
+
+def print_calibration(model_dir):
+    path = os.path.join(model_dir, opencv_detector.CALIBRATION_NAME)
+    with np.load(path) as calibration:
+        shape = calibration['data'].shape
+    print('int8 ranges come from 1 calibration frame with input shape '
+          '{}x{}'.format(shape[2], shape[3]))
+    print()
+
+
+def run_backend(backend, model_dir, frames):
+    det = detector.create_detector(backend, model_dir=model_dir)
+    det.detect(frames[0][0], cv_rules.ALL_CLASSES)
+
+    latencies = []
+    outputs = []
+    for img, _ in frames:
+        start = time.perf_counter()
+        dets_for_class = det.detect(img, cv_rules.ALL_CLASSES)
+        dets_for_class.get_array()
+        latencies.append(time.perf_counter() - start)
+        outputs.append(dets_for_class)
+
+    return np.array(latencies) * 1000, outputs
+
+
+def new_state(dets_for_class, to_server_extras, client_info):
+    result_wrapper = cv_rules.result_wrapper(
+        dets_for_class, to_server_extras.state, client_info)
+    to_client_extras = ikea_pb2.ToClientExtras()
+    result_wrapper.extras.Unpack(to_client_extras)
+    return to_client_extras.state
+
+
+def print_report(frames, latencies, outputs):
+    print('{:<16} {:>9} {:>9} {:>9}'.format(
+        'backend', 'mean ms', 'p50 ms', 'p95 ms'))
+    for backend, backend_latencies in latencies.items():
+        print('{:<16} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            backend, backend_latencies.mean(),
+            np.percentile(backend_latencies, 50),
+            np.percentile(backend_latencies, 95)))
+
+    float_outputs = outputs[detector.OPENCV_CPU]
+    int8_outputs = outputs[detector.OPENCV_CPU_INT8]
+    print()
+    print('{:<12} {:>9} {:>9} {:>13}'.format(
+        'class', 'float', 'int8', 'frames differ'))
+    for cls_idx in cv_rules.ALL_CLASSES:
+        float_counts = np.array([len(dets[cls_idx]) for dets in float_outputs])
+        int8_counts = np.array([len(dets[cls_idx]) for dets in int8_outputs])
+        print('{:<12} {:>9} {:>9} {:>13}'.format(
+            CLASS_NAMES[cls_idx], float_counts.sum(), int8_counts.sum(),
+            (float_counts != int8_counts).sum()))
+
+    client_info = cv_rules.ClientInfo(ikea_pb2.Display(), frozenset())
+    num_different = 0
+    num_transitions = collections.Counter()
+    for (_, to_server_extras), float_dets, int8_dets in zip(
+            frames, float_outputs, int8_outputs):
+        float_state = new_state(float_dets, to_server_extras, client_info)
+        int8_state = new_state(int8_dets, to_server_extras, client_info)
+        if float_state != int8_state:
+            num_different += 1
+        old_step = to_server_extras.state.step
+        num_transitions['float'] += float_state.step != old_step
+        num_transitions['int8'] += int8_state.step != old_step
+
+    print()
+    print('States differ on {} of {} frames. Transitions: {} float, {} '
+          'int8'.format(num_different, len(frames), num_transitions['float'],
+                        num_transitions['int8']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recording', required=True,
+                        help='Directory of a recording')
+    parser.add_argument('--model-dir', default=detector.MODEL_DIR)
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Write calibration inputs instead of the report')
+    parser.add_argument('--skip', type=int, default=0,
+                        help='Number of records to skip')
+    parser.add_argument('--num-frames', type=int, default=0,
+                        help='0 uses every frame after the skipped ones')
+    args = parser.parse_args()
+
+    frames = load_frames(args.recording, args.skip, args.num_frames)
+    if len(frames) == 0:
+        raise Exception('No frames found')
+
+    if args.calibrate:
+        calibrate(frames, args.model_dir)
+        return
+
+    cv_rules.load_assets()
+    print_calibration(args.model_dir)
+    latencies = {}
+    outputs = {}
+    for backend in (detector.OPENCV_CPU, detector.OPENCV_CPU_INT8):
+        latencies[backend], outputs[backend] = run_backend(
+            backend, args.model_dir, frames)
+    print_report(frames, latencies, outputs)
+
+
+if __name__ == '__main__':
+    # Every state change is logged at INFO
+    logging.basicConfig(level=logging.WARNING)
+    main()
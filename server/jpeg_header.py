@@ -0,0 +1,49 @@
+'''Read the size of a JPEG image without decoding it.'''
+
+START_OF_IMAGE = b'\xff\xd8'
+START_OF_SCAN = 0xDA
+
+# Start of frame markers. 0xC4, 0xC8 and 0xCC are in the same range, but they
+# are not frame headers.
+START_OF_FRAME = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Markers that are not followed by a length
+STANDALONE = frozenset(range(0xD0, 0xD9)) | {0x01}
+
+
+def get_size(data):
+    '''Return (height, width) from the frame header of data.
+
+    Return None if data is not a JPEG image, or if the frame header could
+    not be found.'''
+    if data[:2] != START_OF_IMAGE:
+        return None
+
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker in STANDALONE:
+            i += 2
+            continue
+        if marker == START_OF_SCAN:
+            return None
+
+        if marker in START_OF_FRAME:
+            # Length, precision, height, width
+            if i + 9 > len(data):
+                return None
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return height, width
+
+        length = int.from_bytes(data[i + 2:i + 4], 'big')
+        i += 2 + length
+
+    return None
@@ -1,16 +1,98 @@
-from gabriel_server import local_engine
 from ikea_engine import IkeaEngine
+import detector
+import gc
+import http_server
+import ikea_engine
 import logging
+import message_bus
+from multiprocessing import Process
+import os
+import scheduler
+from stage_timer import StageTimer
+
+
+NUM_WORKERS = int(os.getenv('NUM_WORKERS', '1'))
+
+# Number of frames that each client may have in flight. Clients get fewer
+# tokens, down to MIN_TOKENS_PER_CLIENT, while frames take longer than
+# ikea_engine.TARGET_LATENCY.
+MAX_TOKENS_PER_CLIENT = int(os.getenv('MAX_TOKENS_PER_CLIENT', '2'))
+MIN_TOKENS_PER_CLIENT = int(os.getenv('MIN_TOKENS_PER_CLIENT', '1'))
+
+# Workers are assigned to these GPUs in turn
+GPU_IDS = [int(gpu_id) for gpu_id in os.getenv('GPU_IDS', '0').split(',')]
+
+# Give each worker its own set of CPU cores
+PIN_CPUS = os.getenv('PIN_CPUS', '0') == '1'
+
+# Load the networks once, before the workers are forked, so that every
+# worker shares the same copy of the weights. This is only done for
+# detector.FORK_SAFE_BACKENDS.
+SHARE_WEIGHTS = os.getenv('SHARE_WEIGHTS', '1') == '1'
 
 
 logging.basicConfig(level=logging.INFO)
 
 
+def start_http_server(http_server_socks, engine_socks):
+    # Only the workers may hold the engine ends of the message bus, so that
+    # the HTTP server reads EOF when a worker dies
+    for engine_sock in engine_socks:
+        engine_sock.close()
+    http_server.start_http_server(http_server_socks)
+
+
 def main():
-    def engine_factory():
-        return IkeaEngine()
+    http_server_socks = []
+    engine_socks = []
+    for _ in range(NUM_WORKERS):
+        engine_sock, http_server_sock = message_bus.create_socket_pair()
+        http_server_socks.append(http_server_sock)
+        engine_socks.append(engine_sock)
+
+    http_server_process = Process(
+        target=start_http_server, args=(http_server_socks, engine_socks))
+    http_server_process.start()
+
+    # Likewise, engines read EOF when the HTTP server dies
+    for http_server_sock in http_server_socks:
+        http_server_sock.close()
+
+    # Assets load while the detectors load, and they only overlap if both
+    # load in the same process. With shared weights, both load here and the
+    # workers share them. Otherwise each worker loads its own assets while
+    # its detector loads, so assets are not shared between workers.
+    startup_timer = StageTimer()
+    detector_pool = None
+    task_list = None
+    if SHARE_WEIGHTS and (
+            ikea_engine.DETECTOR_BACKEND in detector.FORK_SAFE_BACKENDS):
+        detector_pool = detector.DetectorPool(ikea_engine.DETECTOR_BACKEND)
+        with startup_timer.measure('total'):
+            task_list = ikea_engine.load_tasks(detector_pool, startup_timer)
+
+    # Objects that exist now are never collected, so the garbage collector
+    # in each worker does not write to their pages and copy them. This needs
+    # Python 3.7.
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+    def engine_factory(worker_id):
+        for other_id, engine_sock in enumerate(engine_socks):
+            if other_id != worker_id:
+                engine_sock.close()
+        return IkeaEngine(engine_socks[worker_id],
+                          GPU_IDS[worker_id % len(GPU_IDS)],
+                          task_list=task_list, detector_pool=detector_pool,
+                          startup_timer=startup_timer)
 
-    local_engine.run(engine_factory, 'ikea', 60, 9099, 2)
+    target_latency = None
+    if ikea_engine.TARGET_LATENCY > 0:
+        target_latency = ikea_engine.TARGET_LATENCY
+    scheduler.run(engine_factory, 'ikea', 60, 9099, MAX_TOKENS_PER_CLIENT,
+                  NUM_WORKERS, PIN_CPUS, min_tokens=MIN_TOKENS_PER_CLIENT,
+                  target_latency=target_latency,
+                  close_after_start=engine_socks)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+'''Framed messages between engine workers and the HTTP server.
+
+Each engine worker has one end of a socketpair, and the HTTP server has the
+other. Every message is a JSON object, sent with a four byte big endian length
+prefix. A request has an "id", and the reply to it has a matching "reply_to".
+
+The engine end never blocks for longer than the timeout that it is given. If
+the HTTP server stops reading, messages queue up to a limit and then get
+dropped, rather than stalling the engine. If the HTTP server goes away, every
+later message is dropped, and requests get no reply.'''
+
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import select
+import socket
+import struct
+import time
+
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 1 << 20
+MAX_PENDING_FRAMES = 64
+RECV_SIZE = 4096
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_socket_pair():
+    '''Return (engine_sock, server_sock).'''
+    return socket.socketpair()
+
+
+def _encode(message):
+    payload = json.dumps(message).encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError('Message too large')
+    return HEADER.pack(len(payload)) + payload
+
+
+class EngineBus:
+    '''The engine end of the bus. This is not thread safe.'''
+
+    def __init__(self, sock):
+        sock.setblocking(False)
+        self._sock = sock
+        self._ids = itertools.count()
+        self._pending = collections.deque()
+        self._recv_buffer = bytearray()
+        self._closed = False
+        self._num_dropped = 0
+
+    def _close(self, error):
+        if not self._closed:
+            logger.error('Message bus to HTTP server closed: %s', error)
+            self._closed = True
+        self._num_dropped += len(self._pending)
+        self._pending.clear()
+
+    def _flush(self):
+        while len(self._pending) > 0:
+            try:
+                num_sent = self._sock.send(self._pending[0])
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self._close(e)
+                return
+
+            if num_sent < len(self._pending[0]):
+                # The rest of this frame goes first next time, so frames never
+                # get interleaved
+                self._pending[0] = self._pending[0][num_sent:]
+                return
+            self._pending.popleft()
+
+    def get_num_pending(self):
+        '''Return the number of messages waiting to be sent.'''
+        return len(self._pending)
+
+    def get_num_dropped(self):
+        '''Return the number of messages that were dropped.'''
+        return self._num_dropped
+
+    def send(self, message):
+        '''Send a message that does not need a reply.
+
+        Return False if the message was dropped.'''
+        self._flush()
+        if self._closed:
+            self._num_dropped += 1
+            return False
+        if len(self._pending) >= MAX_PENDING_FRAMES:
+            logger.warning('HTTP server is not reading. Dropping message.')
+            self._num_dropped += 1
+            return False
+
+        self._pending.append(_encode(message))
+        self._flush()
+        return not self._closed
+
+    def request(self, message, timeout):
+        '''Send message and wait for the reply.
+
+        Return the reply, or None if there was no reply within timeout
+        seconds or the HTTP server closed the bus.'''
+        request_id = next(self._ids)
+        message = dict(message, id=request_id)
+        if not self.send(message):
+            return None
+
+        deadline = time.monotonic() + timeout
+        while True:
+            for reply in self._read_frames():
+                if reply.get('reply_to') == request_id:
+                    return reply
+
+                # Replies to requests that timed out earlier end up here
+                logger.info('Ignoring stale reply: %s', reply)
+
+            if self._closed:
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning('No reply to request %d', request_id)
+                return None
+
+            writable = [self._sock] if len(self._pending) > 0 else []
+            select.select([self._sock], writable, [], remaining)
+            self._flush()
+
+    def _read_frames(self):
+        while True:
+            try:
+                data = self._sock.recv(RECV_SIZE)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self._close(e)
+                break
+            if len(data) == 0:
+                self._close('end of file')
+                break
+            self._recv_buffer += data
+
+        frames = []
+        while len(self._recv_buffer) >= HEADER.size:
+            (length,) = HEADER.unpack_from(self._recv_buffer)
+            end = HEADER.size + length
+            if len(self._recv_buffer) < end:
+                break
+            frames.append(json.loads(bytes(self._recv_buffer[HEADER.size:end])))
+            del self._recv_buffer[:end]
+
+        return frames
+
+
+async def serve(sock, handler):
+    '''Read messages from one engine worker until it disconnects.
+
+    handler is called with each message. Its return value is sent back as
+    the reply when the message is a request.'''
+    reader, writer = await asyncio.open_connection(sock=sock)
+    while True:
+        try:
+            header = await reader.readexactly(HEADER.size)
+            (length,) = HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError('Message too large')
+            message = json.loads(await reader.readexactly(length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info('Engine worker closed the message bus')
+            return
+
+        request_id = message.pop('id', None)
+        reply = handler(message)
+        if request_id is None:
+            continue
+
+        reply = dict(reply or {}, reply_to=request_id)
+        writer.write(_encode(reply))
+        await writer.drain()
@@ -0,0 +1,157 @@
+'''Counters, gauges and histograms, and rendering them for Prometheus.
+
+Engine workers record into a Registry. Now and then, they send
+Registry.snapshot() to the HTTP server, which renders the snapshots from all
+workers on /metrics. Counts in a snapshot are totals since the worker
+started, so a lost snapshot loses nothing.'''
+
+import bisect
+import collections
+
+
+# Upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2,
+                   5)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+PREFIX = 'ikea_'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self._buckets = buckets
+
+        # The last count is for values above every bucket
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def to_dict(self):
+        return {
+            'buckets': list(self._buckets),
+            'counts': list(self._counts),
+            'sum': self._sum,
+        }
+
+
+class Registry:
+    '''Metrics for one process. Labels are given as keyword arguments.'''
+
+    def __init__(self):
+        self._counters = collections.Counter()
+        self._gauges = {}
+        self._histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        self._counters[_key(name, labels)] += amount
+
+    def set_counter(self, name, value, **labels):
+        '''Set a counter to a total that is kept somewhere else.'''
+        self._counters[_key(name, labels)] = value
+
+    def set_gauge(self, name, value, **labels):
+        self._gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, buckets, **labels):
+        key = _key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(buckets)
+            self._histograms[key] = histogram
+        histogram.observe(value)
+
+    def add_histogram(self, name, histogram, **labels):
+        '''Include a histogram that is updated somewhere else.'''
+        self._histograms[_key(name, labels)] = histogram
+
+    def snapshot(self):
+        '''Return the current values, in a form that can be sent as JSON.'''
+        return {
+            'counters': [[name, dict(labels), value]
+                         for (name, labels), value in self._counters.items()],
+            'gauges': [[name, dict(labels), value]
+                       for (name, labels), value in self._gauges.items()],
+            'histograms': [
+                [name, dict(labels), histogram.to_dict()]
+                for (name, labels), histogram in self._histograms.items()],
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for label, value in labels) + '}'
+
+
+def render(snapshots, gauges=()):
+    '''Return snapshots in the Prometheus text format.
+
+    snapshots maps a worker id to the last snapshot from that worker.
+    Counters and histograms are summed over workers. Gauges get a worker
+    label. gauges has (name, labels, value) entries from this process.'''
+    counters = collections.Counter()
+    all_gauges = [(name, _key(name, labels)[1], value)
+                  for name, labels, value in gauges]
+    histograms = {}
+    for worker_id, snapshot in sorted(snapshots.items()):
+        for name, labels, value in snapshot['counters']:
+            counters[_key(name, labels)] += value
+        for name, labels, value in snapshot['gauges']:
+            all_gauges.append(
+                (name, _key(name, dict(labels, worker=worker_id))[1], value))
+        for name, labels, histogram in snapshot['histograms']:
+            key = _key(name, labels)
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = dict(histogram, counts=list(
+                    histogram['counts']))
+            else:
+                total['counts'] = [a + b for a, b in zip(
+                    total['counts'], histogram['counts'])]
+                total['sum'] += histogram['sum']
+
+    lines = []
+    _render_simple(lines, 'counter', sorted(
+        (name, labels, value) for (name, labels), value in counters.items()))
+    _render_simple(lines, 'gauge', sorted(all_gauges))
+
+    typed = set()
+    for (name, labels), histogram in sorted(histograms.items()):
+        name = PREFIX + name
+        if name not in typed:
+            lines.append('# TYPE {} histogram'.format(name))
+            typed.add(name)
+
+        cumulative = 0
+        bounds = [str(bound) for bound in histogram['buckets']] + ['+Inf']
+        for bound, count in zip(bounds, histogram['counts']):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels + (('le', bound),)), cumulative))
+        lines.append('{}_sum{} {}'.format(
+            name, _format_labels(labels), histogram['sum']))
+        lines.append('{}_count{} {}'.format(
+            name, _format_labels(labels), cumulative))
+
+    return '\n'.join(lines) + '\n'
+
+
+def _render_simple(lines, metric_type, entries):
+    typed = set()
+    for name, labels, value in entries:
+        name = PREFIX + name
+        if name not in typed:
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            typed.add(name)
+        lines.append('{}{} {}'.format(name, _format_labels(labels), value))
@@ -0,0 +1,169 @@
+import ast
+import logging
+import os
+import re
+
+import cv2
+import numpy as np
+
+from detector import Detector
+from detector import CAFFEMODEL_NAME
+from detector import PROTOTXT_NAME
+from detector import get_blobs
+
+
+# OpenCV cannot run the Python proposal layer from py-faster-rcnn, so the
+# prototxt is loaded with the "rpn.proposal_layer" Python layer replaced by
+# OpenCV's built in layer of type "Proposal", with the same feat_stride and
+# scales. See cpu_prototxt. A model directory can instead have its own
+# edited copy of the prototxt with this name. The weights are shared between
+# both backends.
+CPU_PROTOTXT_NAME = 'faster_rcnn_test_cv.pt'
+
+# Defaults of py-faster-rcnn's proposal layer and generate_anchors
+DEFAULT_FEAT_STRIDE = 16
+DEFAULT_SCALES = (8, 16, 32)
+ANCHOR_RATIOS = (0.5, 1, 2)
+
+# A layer block, with at most one level of nested blocks
+_LAYER_RE = re.compile(r'layer\s*\{(?:[^{}]|\{[^{}]*\})*\}')
+
+# Written by int8_report.py --calibrate. Each model directory needs its own.
+CALIBRATION_NAME = 'int8_calibration.npz'
+
+# Leave this unset to let OpenCV use every core on the node
+NUM_THREADS = os.getenv('OPENCV_NUM_THREADS')
+
+
+logger = logging.getLogger(__name__)
+
+
+def _proposal_layer(layer):
+    '''Return the text of an OpenCV Proposal layer that does the same as the
+    py-faster-rcnn Python layer in layer.'''
+    name = re.search(r'name:\s*([\'"])(.*?)\1', layer).group(2)
+    bottoms = [match[1] for match in re.findall(
+        r'bottom:\s*([\'"])(.*?)\1', layer)]
+    tops = [match[1] for match in re.findall(r'top:\s*([\'"])(.*?)\1', layer)]
+
+    # param_str is YAML, such as "'feat_stride': 16"
+    param_str = re.search(r'param_str:\s*([\'"])(.*?)\1', layer)
+    params = {}
+    if param_str is not None:
+        try:
+            params = ast.literal_eval('{' + param_str.group(2) + '}')
+        except (SyntaxError, ValueError):
+            raise ValueError(
+                'Cannot read param_str of layer {}. Write {} by hand.'.format(
+                    name, CPU_PROTOTXT_NAME))
+
+    # OpenCV's layer also outputs the score of each proposal
+    if len(tops) == 1:
+        tops.append(name + '_scores')
+
+    lines = ['layer {', "  name: '{}'".format(name), "  type: 'Proposal'"]
+    lines += ["  bottom: '{}'".format(bottom) for bottom in bottoms]
+    lines += ["  top: '{}'".format(top) for top in tops]
+    lines.append('  proposal_param {')
+    lines.append('    feat_stride: {}'.format(
+        params.get('feat_stride', DEFAULT_FEAT_STRIDE)))
+    lines += ['    ratio: {}'.format(ratio) for ratio in ANCHOR_RATIOS]
+    lines += ['    scale: {}'.format(scale)
+              for scale in params.get('scales', DEFAULT_SCALES)]
+    lines += ['  }', '}']
+    return '\n'.join(lines)
+
+
+def cpu_prototxt(prototxt):
+    '''Return the text of prototxt, with the py-faster-rcnn proposal layer
+    replaced by OpenCV's Proposal layer.'''
+    num_replaced = 0
+
+    def replace(match):
+        nonlocal num_replaced
+        layer = match.group(0)
+        if 'rpn.proposal_layer' not in layer:
+            return layer
+        num_replaced += 1
+        return _proposal_layer(layer)
+
+    text = _LAYER_RE.sub(replace, prototxt)
+    if num_replaced != 1:
+        raise ValueError(
+            'Expected one rpn.proposal_layer, found {}. Write {} by '
+            'hand.'.format(num_replaced, CPU_PROTOTXT_NAME))
+    return text
+
+
+class OpenCvDetector(Detector):
+    def __init__(self, model_dir):
+        super().__init__()
+        if NUM_THREADS is not None:
+            cv2.setNumThreads(int(NUM_THREADS))
+
+        caffemodel = os.path.join(model_dir, CAFFEMODEL_NAME)
+        edited_prototxt = os.path.join(model_dir, CPU_PROTOTXT_NAME)
+        if os.path.isfile(edited_prototxt):
+            self.net = cv2.dnn.readNetFromCaffe(edited_prototxt, caffemodel)
+        else:
+            prototxt = os.path.join(model_dir, PROTOTXT_NAME)
+            if not os.path.isfile(prototxt):
+                raise IOError(('{:s} not found.').format(prototxt))
+            with open(prototxt) as f:
+                text = cpu_prototxt(f.read())
+            self.net = cv2.dnn.readNetFromCaffe(
+                np.frombuffer(text.encode(), dtype=np.uint8),
+                np.fromfile(caffemodel, dtype=np.uint8))
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        logger.info('OpenCV net from %s has been initilized on CPU',
+                    model_dir)
+
+    def _forward(self, img, img_scale):
+        data, im_info, img_scale = get_blobs(
+            img, self._blob_buffers, img_scale=img_scale)
+        self.net.setInput(data, 'data')
+        self.net.setInput(im_info, 'im_info')
+        rois, cls_prob, bbox_pred = self.net.forward(
+            ['rois', 'cls_prob', 'bbox_pred'])
+
+        rois = rois.reshape(-1, 5)
+        scores = cls_prob.reshape(rois.shape[0], -1)
+        box_deltas = bbox_pred.reshape(rois.shape[0], -1)
+
+        # Unscale back to raw image space
+        boxes = rois[:, 1:5] / img_scale
+
+        return scores, boxes, box_deltas
+
+
+class QuantizedOpenCvDetector(OpenCvDetector):
+    '''Runs the layers that OpenCV can quantize in int8, and the rest in
+    float. Inputs and outputs stay float, so this is used like
+    OpenCvDetector.
+
+    Quantization ranges come from one forward pass over the calibration
+    frame in the model directory. It is a single frame because the Proposal
+    layer only takes one image per pass. This needs OpenCV 4.6 or later.'''
+
+    def __init__(self, model_dir):
+        super().__init__(model_dir)
+        if not hasattr(self.net, 'quantize'):
+            raise Exception(
+                'OpenCV {} cannot quantize networks'.format(cv2.__version__))
+
+        calibration_path = os.path.join(model_dir, CALIBRATION_NAME)
+        if not os.path.isfile(calibration_path):
+            raise IOError(('{:s} not found.').format(calibration_path))
+        with np.load(calibration_path) as calibration:
+            calibration_inputs = [calibration['data'], calibration['im_info']]
+        if len(calibration_inputs[0]) != 1:
+            raise Exception(
+                '{} has more than one frame. Run int8_report.py --calibrate '
+                'again.'.format(calibration_path))
+
+        self.net = self.net.quantize(
+            calibration_inputs, cv2.CV_32F, cv2.CV_32F)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        logger.info('Quantized net from %s', model_dir)
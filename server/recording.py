@@ -0,0 +1,279 @@
+'''Record the frames that an engine handles, and read recordings back.
+
+A recording is a directory of segments. Each segment has a data file and an
+index file. The data file holds the records one after another. A record is
+the frame's payload, then the serialized ToServerExtras, then the serialized
+ToClientExtras from the result. The index file has one fixed size entry per
+record, with the offset and lengths of its parts, so readers can memory map
+the index and seek to any record without reading the data before it.
+
+Recorder.record only puts the record in a bounded queue. A thread writes the
+queue to disk, and records are dropped when the queue is full.'''
+
+import logging
+import mmap
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import ikea_pb2
+
+
+DATA_SUFFIX = '.data'
+INDEX_SUFFIX = '.index'
+
+# new_step of a record whose result did not change the step
+NO_TRANSITION = -1
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('payload_length', '<u4'),
+    ('to_server_length', '<u4'),
+    ('to_client_length', '<u4'),
+
+    # gabriel_pb2.ResultWrapper.Status of the result
+    ('status', '<i4'),
+
+    # The step that the frame was sent on, and the step that the result
+    # moved the client to
+    ('step', '<i4'),
+    ('new_step', '<i4'),
+
+    # Seconds since the epoch
+    ('time', '<f8'),
+])
+
+
+logger = logging.getLogger(__name__)
+
+
+class Recorder:
+    '''Writes records to a new directory in parent_dir.
+
+    A segment is closed, and the next one started, once its data file has
+    max_segment_bytes. At most max_pending records wait to be written.'''
+
+    def __init__(self, parent_dir, max_segment_bytes, max_pending):
+        self._directory = os.path.join(parent_dir, '{}-{}'.format(
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        os.makedirs(self._directory)
+        self._max_segment_bytes = max_segment_bytes
+        self._pending = queue.Queue(max_pending)
+        self._num_dropped = 0
+
+        self._segment = 0
+        self._data_file = None
+        self._index_file = None
+        self._offset = 0
+
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        logger.info('Recording to %s', self._directory)
+
+    def get_directory(self):
+        return self._directory
+
+    def get_num_dropped(self):
+        return self._num_dropped
+
+    def record(self, input_frame, result_wrapper):
+        '''Queue input_frame and its result to be written. This does not
+        block.'''
+        payload = input_frame.payloads[0] if input_frame.payloads else b''
+        record = (
+            time.time(), payload, input_frame.extras.value,
+            result_wrapper.extras.value, result_wrapper.status)
+        try:
+            self._pending.put_nowait(record)
+        except queue.Full:
+            self._num_dropped += 1
+
+    def close(self):
+        '''Write the queued records and stop the thread.'''
+        self._pending.put(None)
+        self._thread.join()
+
+    def _write_loop(self):
+        while True:
+            records = [self._pending.get()]
+
+            # Write everything that is queued before flushing
+            while records[-1] is not None:
+                try:
+                    records.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = records[-1] is None
+            if stop:
+                records.pop()
+
+            try:
+                self._write(records)
+            except OSError:
+                logger.exception('Could not write recording')
+                self._num_dropped += len(records)
+
+            if stop:
+                self._close_segment()
+                return
+
+    def _write(self, records):
+        entries = []
+        for timestamp, payload, to_server, to_client, status in records:
+            if self._data_file is None:
+                self._open_segment()
+
+            step, new_step = _steps(to_server, to_client)
+            entries.append((
+                self._offset, len(payload), len(to_server), len(to_client),
+                status, step, new_step, timestamp))
+            self._data_file.write(payload)
+            self._data_file.write(to_server)
+            self._data_file.write(to_client)
+            self._offset += len(payload) + len(to_server) + len(to_client)
+
+            if self._offset >= self._max_segment_bytes:
+                self._write_index(entries)
+                entries = []
+                self._close_segment()
+
+        if len(entries) > 0:
+            self._write_index(entries)
+
+    def _write_index(self, entries):
+        # Index entries are only written after their data, so readers never
+        # see an entry that points past the end of the data file
+        self._data_file.flush()
+        np.array(entries, dtype=INDEX_DTYPE).tofile(self._index_file)
+        self._index_file.flush()
+
+    def _open_segment(self):
+        name = os.path.join(self._directory, '{:06d}'.format(self._segment))
+        self._data_file = open(name + DATA_SUFFIX, 'wb')
+        self._index_file = open(name + INDEX_SUFFIX, 'wb')
+        self._segment += 1
+        self._offset = 0
+
+    def _close_segment(self):
+        if self._data_file is None:
+            return
+
+        self._data_file.close()
+        self._index_file.close()
+        self._data_file = None
+        self._index_file = None
+
+
+def _steps(to_server, to_client):
+    '''Return the step that a frame was sent on, and the step that its
+    result moved the client to.'''
+    to_server_extras = ikea_pb2.ToServerExtras()
+    to_server_extras.ParseFromString(to_server)
+    to_client_extras = ikea_pb2.ToClientExtras()
+    to_client_extras.ParseFromString(to_client)
+
+    new_step = NO_TRANSITION
+    if to_client_extras.HasField('state'):
+        new_step = to_client_extras.state.step
+    return to_server_extras.state.step, new_step
+
+
+class Record:
+    def __init__(self, entry, data):
+        self.time = float(entry['time'])
+        self.status = int(entry['status'])
+        self.step = int(entry['step'])
+        self.new_step = int(entry['new_step'])
+
+        start = int(entry['offset'])
+        end = start + int(entry['payload_length'])
+        self.payload = data[start:end]
+        start, end = end, end + int(entry['to_server_length'])
+        self.to_server = data[start:end]
+        start, end = end, end + int(entry['to_client_length'])
+        self.to_client = data[start:end]
+
+    def get_to_server_extras(self):
+        to_server_extras = ikea_pb2.ToServerExtras()
+        to_server_extras.ParseFromString(self.to_server)
+        return to_server_extras
+
+    def get_to_client_extras(self):
+        to_client_extras = ikea_pb2.ToClientExtras()
+        to_client_extras.ParseFromString(self.to_client)
+        return to_client_extras
+
+
+class RecordingReader:
+    '''Memory maps the segments of a recording. Records are numbered across
+    all segments, in the order they were written.
+
+    A recording can be read while it is still being written. Only the
+    records that were indexed when the reader was created are included.'''
+
+    def __init__(self, directory):
+        self._indexes = []
+        self._data = []
+        names = sorted(name[:-len(INDEX_SUFFIX)]
+                       for name in os.listdir(directory)
+                       if name.endswith(INDEX_SUFFIX))
+        for name in names:
+            path = os.path.join(directory, name)
+
+            # An entry that is only partly written is left out
+            num_entries = os.path.getsize(path + INDEX_SUFFIX) // (
+                INDEX_DTYPE.itemsize)
+            if num_entries == 0:
+                continue
+
+            self._indexes.append(np.memmap(
+                path + INDEX_SUFFIX, dtype=INDEX_DTYPE, mode='r',
+                shape=(num_entries,)))
+            with open(path + DATA_SUFFIX, 'rb') as data_file:
+                self._data.append(mmap.mmap(
+                    data_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+        # Number of records before each segment
+        self._starts = np.cumsum(
+            [0] + [len(index) for index in self._indexes])
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        segment = np.searchsorted(self._starts, i, side='right') - 1
+        return Record(self._indexes[segment][i - self._starts[segment]],
+                      self._data[segment])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_index(self):
+        '''Return the index entries of every record, as one array with
+        INDEX_DTYPE.'''
+        if len(self._indexes) == 0:
+            return np.empty(0, dtype=INDEX_DTYPE)
+        return np.concatenate(self._indexes)
+
+    def find_transitions(self):
+        '''Return the numbers of the records whose results changed the
+        step.'''
+        index = self.get_index()
+        return np.flatnonzero(
+            (index['new_step'] != NO_TRANSITION) &
+            (index['new_step'] != index['step']))
+
+    def find_time(self, timestamp):
+        '''Return the number of the first record from timestamp or
+        later.'''
+        return int(np.searchsorted(self.get_index()['time'], timestamp))
@@ -0,0 +1,89 @@
+'''Crop frames to the region around a parent box from an earlier frame.
+
+On steps that only read objects inside a parent box, such as the buckles
+inside the shade top, the detector can run on a crop around where the parent
+was last seen. The crop is scaled like its frame, so the network sees fewer
+pixels but objects keep their size.'''
+
+import numpy as np
+
+import detector
+
+
+def expand(box, margin, img_shape):
+    '''Return (x1, y1, x2, y2) integer crop coordinates for box, grown by
+    margin times its width and height on every side and clipped to the
+    frame.'''
+    x1, y1, x2, y2 = box[:4]
+    margin_x = (x2 - x1) * margin
+    margin_y = (y2 - y1) * margin
+    height, width = img_shape[:2]
+    return (max(int(np.floor(x1 - margin_x)), 0),
+            max(int(np.floor(y1 - margin_y)), 0),
+            min(int(np.ceil(x2 + margin_x)), width),
+            min(int(np.ceil(y2 + margin_y)), height))
+
+
+def best_box(dets, min_confidence):
+    '''Return the most confident row of dets, or None if it is below
+    min_confidence. Rows for one class are sorted by decreasing
+    confidence.'''
+    if len(dets) == 0 or dets[0, 4] < min_confidence:
+        return None
+    return dets[0]
+
+
+def saves_compute(crop, img_shape, img_scale):
+    '''Return True if the network input for crop fits a smaller input bucket
+    than the whole frame, when both are scaled by img_scale.'''
+    x1, y1, x2, y2 = crop
+    height, width = img_shape[:2]
+    crop_height, crop_width = detector.get_input_bucket(
+        int(np.round((y2 - y1) * img_scale)),
+        int(np.round((x2 - x1) * img_scale)))
+    img_height, img_width = detector.get_input_bucket(
+        int(np.round(height * img_scale)), int(np.round(width * img_scale)))
+    return crop_height * crop_width < img_height * img_width
+
+
+def shift(dets, x_offset, y_offset):
+    '''Return a copy of dets with boxes moved from crop to frame
+    coordinates.'''
+    shifted = dets.copy()
+    shifted[:, [0, 2]] += x_offset
+    shifted[:, [1, 3]] += y_offset
+    return shifted
+
+
+class RegionOfInterest:
+    '''The crop for one session, valid while it stays on step and sends
+    frames of img_shape.'''
+
+    def __init__(self, step, img_shape, crop):
+        self._step = step
+        self._img_shape = img_shape
+        self._crop = crop
+        self._num_used = 0
+
+    def get_step(self):
+        return self._step
+
+    def get_img_shape(self):
+        return self._img_shape
+
+    def get_crop(self):
+        return self._crop
+
+    def get_num_used(self):
+        return self._num_used
+
+    def move(self, crop):
+        '''Follow the parent box to crop, without resetting the number of
+        times this region was used.'''
+        self._crop = crop
+
+    def use(self, img):
+        '''Return the crop of img.'''
+        self._num_used += 1
+        x1, y1, x2, y2 = self._crop
+        return img[y1:y2, x1:x2]
@@ -0,0 +1,368 @@
+'''Run a pool of engine workers, and give them frames from all clients.
+
+This replaces gabriel_server.local_engine.run. Every worker is a separate
+process with its own engine, and all workers consume frames from the same
+source. Frames wait in a queue while every worker is busy. When a worker is
+free, the oldest queued frame is sent to it right away. Frames are not
+batched, because the detectors in detector.py run one image per forward
+pass, so a batch would only make its first frames wait for the others.
+
+engine_factory is called with the index of the worker, in the worker's
+process. The engine must have a handle_batch method that takes a list of
+InputFrames and returns a list of ResultWrappers in the same order. It is
+given one frame at a time. If the engine has a set_input_queue_depth
+method, it is called before each frame with the number of frames that were
+still queued when the frame was sent. If it has a set_queue_wait method, it
+is called with the seconds that the frame waited in the queue.
+
+Each client starts with num_tokens tokens. If target_latency is set, the
+number of tokens that each client holds goes down to as few as min_tokens
+while frames take longer than target_latency from arriving to their result,
+and back up once they are fast again. See backpressure.LoadLevel. Tokens
+are taken away by not returning them with results. They are given back
+with results that have no extras and only return a token.'''
+
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import time
+from gabriel_protocol import gabriel_pb2
+from gabriel_server import cognitive_engine
+from gabriel_server.websocket_server import WebsocketServer
+
+from backpressure import LoadLevel
+
+
+HEALTH_REPORT_INTERVAL = 30
+
+# Weight of the newest batch in each worker's moving average latency
+LATENCY_SMOOTHING = 0.2
+
+
+logger = logging.getLogger(__name__)
+
+
+def run(engine_factory, source_name, input_queue_maxsize, port, num_tokens,
+        num_workers=1, pin_cpus=False, message_max_size=None, min_tokens=1,
+        target_latency=None, close_after_start=()):
+    '''close_after_start has handles that only the workers should hold,
+    such as their ends of sockets. This process closes its copies once
+    every worker has started.'''
+    scheduling_server = _SchedulingServer(
+        num_tokens, input_queue_maxsize, min_tokens, target_latency)
+    scheduling_server.add_source_consumed(source_name)
+
+    cpu_sets = split_cpus(num_workers) if pin_cpus else [None] * num_workers
+    for worker_id, cpus in enumerate(cpu_sets):
+        engine_conn, server_conn = multiprocessing.Pipe()
+        engine_process = multiprocessing.Process(
+            target=_run_engine,
+            args=(engine_factory, worker_id, cpus, engine_conn))
+        engine_process.start()
+
+        # The worker now holds the only copy of its end, so the server end
+        # reads EOF as soon as the worker dies
+        engine_conn.close()
+        scheduling_server.add_worker(
+            _Worker(worker_id, server_conn, engine_process))
+
+    for handle in close_after_start:
+        handle.close()
+
+    scheduling_server.launch(port, message_max_size)
+
+    raise Exception('Server stopped')
+
+
+def split_cpus(num_workers):
+    '''Split the CPUs that this process may run on into num_workers sets of
+    roughly equal size.'''
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < num_workers:
+        raise ValueError('Cannot pin {} workers to {} CPUs'.format(
+            num_workers, len(cpus)))
+
+    return [set(cpus[worker_id::num_workers])
+            for worker_id in range(num_workers)]
+
+
+class _Worker:
+    def __init__(self, worker_id, conn, process):
+        self._worker_id = worker_id
+        self._conn = conn
+        self._process = process
+        self._result_ready = asyncio.Event()
+        self._batch = None
+        self._sent_time = None
+        self._queue_wait = 0
+        self._last_latency = 0
+        self._last_result_time = None
+        self._num_frames = 0
+        self._latency = None
+
+    def get_worker_id(self):
+        return self._worker_id
+
+    def get_conn(self):
+        return self._conn
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    def is_busy(self):
+        return self._batch is not None
+
+    def get_batch(self):
+        return self._batch
+
+    def get_latency(self):
+        '''Return the moving average of seconds per batch, or 0 if this worker
+        has not returned a batch yet.'''
+        return 0 if self._latency is None else self._latency
+
+    def get_frame_latency(self):
+        '''Return the seconds from the oldest frame of the last batch
+        arriving to its result being ready.'''
+        return self._queue_wait + self._last_latency
+
+    def get_result_ready(self):
+        return self._result_ready
+
+    def has_results(self):
+        return self._conn.poll()
+
+    def send_batch(self, batch, input_queue_depth, queue_wait):
+        self._batch = batch
+        self._sent_time = time.monotonic()
+        self._queue_wait = queue_wait
+        self._conn.send((input_queue_depth, queue_wait, [
+            from_client.input_frame.SerializeToString()
+            for from_client, _ in batch]))
+
+    def recv_results(self):
+        serialized_results = self._conn.recv()
+
+        now = time.monotonic()
+        latency = now - self._sent_time
+        self._last_latency = latency
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+        self._last_result_time = now
+        self._num_frames += len(self._batch)
+
+        batch = self._batch
+        self._batch = None
+        return batch, serialized_results
+
+    def log_health(self):
+        last_result_age = (
+            None if self._last_result_time is None
+            else time.monotonic() - self._last_result_time)
+        logger.info(
+            'Worker %d: alive=%s busy=%s frames=%d latency_ms=%.1f '
+            'last_result_s=%s', self._worker_id, self.is_alive(),
+            self.is_busy(), self._num_frames, self.get_latency() * 1000,
+            'never' if last_result_age is None else
+            '{:.1f}'.format(last_result_age))
+
+
+class _SchedulingServer(WebsocketServer):
+    def __init__(self, num_tokens_per_source, input_queue_maxsize,
+                 min_tokens, target_latency):
+        super().__init__(num_tokens_per_source)
+        self._input_queue = asyncio.Queue(input_queue_maxsize)
+        self._workers = []
+        self._worker_free = asyncio.Event()
+
+        # Level n takes n tokens away from every client
+        self._load_level = None
+        if target_latency is not None and min_tokens < num_tokens_per_source:
+            self._load_level = LoadLevel(
+                num_tokens_per_source - min_tokens + 1, target_latency)
+
+        # Number of tokens that have not been returned to each client
+        self._withheld_tokens = collections.Counter()
+
+    def add_worker(self, worker):
+        self._workers.append(worker)
+
+    async def _send_to_engine(self, from_client, address):
+        if self._input_queue.full():
+            return False
+
+        self._input_queue.put_nowait((time.monotonic(), from_client, address))
+        return True
+
+    async def _handler(self, websocket, path):
+        try:
+            await super()._handler(websocket, path)
+        finally:
+            # Clients that disconnect between results would otherwise keep
+            # their entry
+            self._withheld_tokens.pop(websocket.remote_address, None)
+
+    def launch(self, port, message_max_size):
+        event_loop = asyncio.get_event_loop()
+        for worker in self._workers:
+            event_loop.add_reader(
+                worker.get_conn().fileno(), worker.get_result_ready().set)
+            asyncio.ensure_future(self._receive_from_worker(worker))
+        asyncio.ensure_future(self._engine_comm())
+        asyncio.ensure_future(self._health_loop())
+        super().launch(port, message_max_size)
+
+    def _get_num_tokens(self):
+        '''Return the number of tokens that each client should hold.'''
+        if self._load_level is None:
+            return self._num_tokens_per_source
+        return self._num_tokens_per_source - self._load_level.get()
+
+    async def _next_batch(self):
+        '''Return the time that the oldest frame was received, and a batch
+        with only that frame.'''
+        received, from_client, address = await self._input_queue.get()
+        return received, [(from_client, address)]
+
+    async def _least_loaded_worker(self):
+        '''Wait for a free worker, and return the free worker with the lowest
+        latency.'''
+        while True:
+            free_workers = [worker for worker in self._workers
+                            if worker.is_alive() and not worker.is_busy()]
+            if len(free_workers) > 0:
+                return min(free_workers,
+                           key=lambda worker: worker.get_latency())
+
+            self._worker_free.clear()
+            await self._worker_free.wait()
+
+    async def _engine_comm(self):
+        await self.wait_for_start()
+        while self.is_running():
+            worker = await self._least_loaded_worker()
+            received, batch = await self._next_batch()
+            try:
+                worker.send_batch(batch, self._input_queue.qsize(),
+                                  time.monotonic() - received)
+            except OSError:
+                await self._remove_worker(worker)
+
+    async def _receive_from_worker(self, worker):
+        await self.wait_for_start()
+        while self.is_running() and worker.is_alive():
+            result_ready = worker.get_result_ready()
+            await result_ready.wait()
+            result_ready.clear()
+
+            # The reader callback can run again after the results were read
+            if not worker.has_results():
+                continue
+
+            try:
+                batch, serialized_results = worker.recv_results()
+            except EOFError:
+                await self._remove_worker(worker)
+                return
+            self._worker_free.set()
+
+            if self._load_level is not None and self._load_level.observe(
+                    worker.get_frame_latency()):
+                logger.info(
+                    'Load level %d: %d tokens per client, latency_ms=%.1f',
+                    self._load_level.get(), self._get_num_tokens(),
+                    self._load_level.get_latency() * 1000)
+
+            for (from_client, address), serialized_result in zip(
+                    batch, serialized_results):
+                result_wrapper = gabriel_pb2.ResultWrapper()
+                result_wrapper.ParseFromString(serialized_result)
+                await self._send_result(from_client, address, result_wrapper)
+
+    async def _send_result(self, from_client, address, result_wrapper):
+        '''Send a result, and move the number of tokens that the client
+        holds one step towards _get_num_tokens.'''
+        num_held = self._num_tokens_per_source - self._withheld_tokens[address]
+        num_tokens = self._get_num_tokens()
+        return_token = num_held <= num_tokens
+        sent = await self.send_result_wrapper(
+            address, from_client.source_name, from_client.frame_id,
+            result_wrapper, return_token=return_token)
+        if not sent:
+            # The client is gone
+            self._withheld_tokens.pop(address, None)
+            return
+
+        if not return_token:
+            self._withheld_tokens[address] += 1
+        elif num_held < num_tokens:
+            status = gabriel_pb2.ResultWrapper.Status.SUCCESS
+            sent = await self.send_result_wrapper(
+                address, from_client.source_name, from_client.frame_id,
+                cognitive_engine.create_result_wrapper(status),
+                return_token=True)
+            if sent:
+                self._withheld_tokens[address] -= 1
+                if self._withheld_tokens[address] == 0:
+                    del self._withheld_tokens[address]
+
+    async def _health_loop(self):
+        await self.wait_for_start()
+        while self.is_running():
+            await asyncio.sleep(HEALTH_REPORT_INTERVAL)
+            for worker in list(self._workers):
+                worker.log_health()
+                if not worker.is_alive():
+                    await self._remove_worker(worker)
+
+    async def _remove_worker(self, worker):
+        if worker not in self._workers:
+            return
+
+        logger.error('Worker %d died', worker.get_worker_id())
+        asyncio.get_event_loop().remove_reader(worker.get_conn().fileno())
+        self._workers.remove(worker)
+
+        batch = worker.get_batch()
+        if batch is None:
+            return
+
+        # Return the tokens for the frames that the worker was processing
+        status = gabriel_pb2.ResultWrapper.Status.ENGINE_ERROR
+        result_wrapper = cognitive_engine.create_result_wrapper(status)
+        for from_client, address in batch:
+            await self.send_result_wrapper(
+                address, from_client.source_name, from_client.frame_id,
+                result_wrapper, return_token=True)
+
+
+def _run_engine(engine_factory, worker_id, cpus, conn):
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+        logger.info('Worker %d pinned to CPUs %s', worker_id, sorted(cpus))
+
+    engine = engine_factory(worker_id)
+    logger.info('Cognitive engine %d started', worker_id)
+    set_input_queue_depth = getattr(engine, 'set_input_queue_depth', None)
+    set_queue_wait = getattr(engine, 'set_queue_wait', None)
+    while True:
+        input_queue_depth, queue_wait, serialized_frames = conn.recv()
+        if set_input_queue_depth is not None:
+            set_input_queue_depth(input_queue_depth)
+        if set_queue_wait is not None:
+            set_queue_wait(queue_wait)
+
+        input_frames = []
+        for serialized_frame in serialized_frames:
+            input_frame = gabriel_pb2.InputFrame()
+            input_frame.ParseFromString(serialized_frame)
+            input_frames.append(input_frame)
+
+        logger.debug('Worker %d processing batch of %d frames', worker_id,
+                     len(input_frames))
+        result_wrappers = engine.handle_batch(input_frames)
+        conn.send([result_wrapper.SerializeToString()
+                   for result_wrapper in result_wrappers])
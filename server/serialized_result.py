@@ -0,0 +1,42 @@
+'''ResultWrappers whose results are serialized ahead of time.
+
+The results that a state sends, such as its speech and image, are the same
+for every frame. Only the extras change. Serialized protobuf messages can be
+concatenated, and parsing the concatenation merges them, so the results are
+serialized once and only the extras are serialized for each frame.'''
+
+from gabriel_protocol import gabriel_pb2
+
+
+def serialize_results(results):
+    '''Return a serialized ResultWrapper that only has results.'''
+    result_wrapper = gabriel_pb2.ResultWrapper()
+    result_wrapper.results.extend(results)
+    return result_wrapper.SerializeToString()
+
+
+class SerializedResultWrapper:
+    '''Used in place of a successful ResultWrapper. status and extras work
+    like the fields of a ResultWrapper. The results are only in the
+    serialized message.
+
+    serialized_results is the output of serialize_results. The extras are
+    an Any with type_url and value.'''
+
+    def __init__(self, serialized_results, type_url, value):
+        self.status = gabriel_pb2.ResultWrapper.Status.SUCCESS
+        self._serialized_results = serialized_results
+        self._extras_wrapper = gabriel_pb2.ResultWrapper()
+        self.extras = self._extras_wrapper.extras
+        self.extras.type_url = type_url
+        self.extras.value = value
+
+    def append_results(self, serialized_results):
+        '''Send the results in the output of serialize_results after the
+        others.'''
+        self._serialized_results += serialized_results
+
+    def SerializeToString(self):
+        # SUCCESS is the default status, so it is not serialized
+        return (self._serialized_results +
+                self._extras_wrapper.SerializeToString())
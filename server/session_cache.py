@@ -0,0 +1,31 @@
+import collections
+
+
+class SessionCache:
+    '''Per session values, for at most max_sessions sessions.
+
+    When the cache is full, the session that was used least recently is
+    dropped. Every engine replica has its own caches, so values must only
+    be used as hints that the engine can do without.'''
+
+    def __init__(self, max_sessions):
+        self._max_sessions = max_sessions
+        self._values = collections.OrderedDict()
+
+    def get(self, session_id, default=None):
+        value = self._values.get(session_id, default)
+        if session_id in self._values:
+            self._values.move_to_end(session_id)
+        return value
+
+    def put(self, session_id, value):
+        self._values[session_id] = value
+        self._values.move_to_end(session_id)
+        if len(self._values) > self._max_sessions:
+            self._values.popitem(last=False)
+
+    def pop(self, session_id, default=None):
+        return self._values.pop(session_id, default)
+
+    def __len__(self):
+        return len(self._values)
@@ -0,0 +1,65 @@
+import collections
+import contextlib
+import time
+
+import numpy as np
+
+import metrics
+
+
+# Number of recent durations that are kept for each stage
+MAX_SAMPLES = 10000
+
+
+class StageTimer:
+    '''Durations of the stages that frames go through.
+
+    Counts, totals and histograms cover every measurement. Percentiles only
+    cover the last max_samples measurements of each stage.'''
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self._samples = collections.defaultdict(
+            lambda: collections.deque(maxlen=max_samples))
+        self._counts = collections.Counter()
+        self._totals = collections.Counter()
+        self._histograms = collections.defaultdict(
+            lambda: metrics.Histogram(metrics.LATENCY_BUCKETS))
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        self._samples[stage].append(seconds)
+        self._counts[stage] += 1
+        self._totals[stage] += seconds
+        self._histograms[stage].observe(seconds)
+
+    def get_stages(self):
+        '''Return the stages in the order they were first measured.'''
+        return list(self._samples)
+
+    def get_count(self, stage):
+        return self._counts[stage]
+
+    def get_total(self, stage):
+        '''Return the total seconds spent in stage.'''
+        return self._totals[stage]
+
+    def get_histogram(self, stage):
+        return self._histograms[stage]
+
+    def get_percentiles(self, stage, percentiles):
+        '''Return the given percentiles of the recent durations of stage, in
+        seconds.'''
+        return np.percentile(np.array(self._samples[stage]), percentiles)
+
+    def clear(self):
+        self._samples.clear()
+        self._counts.clear()
+        self._totals.clear()
+        self._histograms.clear()
@@ -1,5 +1,6 @@
 let oldState = null;
-const socket = new WebSocket('wss://' + location.host + '/ws');
+const socket = new WebSocket(
+    'wss://' + location.host + '/ws?session=' + encodeURIComponent(sessionId));
 
 socket.addEventListener('message', function (event) {
     var msg = JSON.parse(event.data);
@@ -0,0 +1,83 @@
+'''Assembly tasks that one engine can host.
+
+A task is a rules module like cv_rules, with its own states and instruction
+images. The module must define:
+    State: an Enum of the steps. Members have get_proto_step,
+        update_result_wrapper and result_wrapper_without_update. These,
+        and result_wrapper, return a ResultWrapper or a
+        serialized_result.SerializedResultWrapper.
+    FIRST_STATE: the State that new clients start on.
+    CLASSES_FOR_STEP: the classes that each detector step reads.
+    result_wrapper(dets_for_class, old_state, client_info)
+    get_transition_counts()
+    load_assets(): loads the instruction images. It is called once, before
+        any results are made.
+It can also set MODEL_DIR, if it does not use detector.MODEL_DIR. Tasks
+with the same MODEL_DIR share one detector. ROI_CLASS_FOR_STEP can map
+steps to the class whose boxes contain everything that the step reads. See
+roi.py. MAX_FRAME_WH_FOR_STEP can map steps to the long side, in pixels,
+of the frames that they need.
+
+Every task uses the State message, and START and DONE mean the same thing
+for all of them. Clients pick a task with ToServerExtras.task.
+
+Loading the assets of tasks before the engine workers are forked lets the
+workers share these pages.'''
+
+import importlib
+
+import detector
+
+
+class Task:
+    def __init__(self, name, rules):
+        self._name = name
+        self._rules = rules
+        self._proto_to_state = {
+            state.get_proto_step(): state for state in rules.State}
+
+    def get_name(self):
+        return self._name
+
+    def get_rules(self):
+        return self._rules
+
+    def get_model_dir(self):
+        return getattr(self._rules, 'MODEL_DIR', detector.MODEL_DIR)
+
+    def get_roi_class(self, proto_step):
+        '''Return the class to crop around on proto_step, or None.'''
+        return getattr(self._rules, 'ROI_CLASS_FOR_STEP', {}).get(proto_step)
+
+    def get_max_frame_wh(self, proto_step):
+        '''Return the long side of the frames that proto_step needs, or None
+        for full size frames.'''
+        return getattr(self._rules, 'MAX_FRAME_WH_FOR_STEP', {}).get(
+            proto_step)
+
+    def load_assets(self):
+        self._rules.load_assets()
+
+    def get_state(self, proto_step):
+        '''Return the State for proto_step, or None if this task does not
+        have one.'''
+        return self._proto_to_state.get(proto_step)
+
+
+def load(spec):
+    '''Return a list of Tasks, without their assets.
+
+    spec is a comma separated list of name=module entries, such as
+    "ikea=cv_rules". The first task is used for frames that do not name a
+    task.'''
+    task_list = []
+    for entry in spec.split(','):
+        name, sep, module_name = entry.strip().partition('=')
+        if sep == '' or name == '' or module_name == '':
+            raise ValueError('Bad task: {}'.format(entry))
+        if any(task.get_name() == name for task in task_list):
+            raise ValueError('Task {} is listed twice'.format(name))
+
+        task_list.append(Task(name, importlib.import_module(module_name)))
+
+    return task_list
@@ -0,0 +1,236 @@
+'''Check that the vectorized spatial rules in cv_rules give the same answers
+as the nested loops that they replaced.
+
+Run from the server directory with:
+    python3 -m unittest test_cv_rules
+'''
+
+import unittest
+
+import numpy as np
+
+import cv_rules
+import geometry
+
+
+NUM_RANDOM_FRAMES = 5000
+
+
+# The loops below are the rules from before geometry.py, reduced to the
+# predicate that each one checked. They ran on NumPy 1.x, where a float32
+# scalar became float64 when it was divided by a Python int or multiplied by
+# a Python float. NumPy 2 keeps it in float32, so the sums and differences
+# are turned into Python floats at those points to get the old answers.
+
+def _loop_pipe_on_base(bases, pipes):
+    for base in bases:
+        base_center = (float(base[0] + base[2]) / 2,
+                       float(base[1] + base[3]) / 2)
+        base_width = float(base[2] - base[0])
+        base_height = base[3] - base[1]
+        for pipe in pipes:
+            pipe_center = (float(pipe[0] + pipe[2]) / 2,
+                           float(pipe[1] + pipe[3]) / 2)
+            pipe_height = pipe[3] - pipe[1]
+            if pipe_center[1] > base_center[1]:
+                continue
+            if pipe_center[0] < base_center[0] - base_width * 0.25 or (
+                    pipe_center[0] > base_center[0] + base_width * 0.25):
+                continue
+            if pipe_height / base_height < 1.5:
+                continue
+
+            return True
+
+    return False
+
+
+def _loop_count_buckles(shadetops, buckles):
+    for shadetop in shadetops:
+        shadetop_center = ((shadetop[0] + shadetop[2]) / 2,
+                           (shadetop[1] + shadetop[3]) / 2)
+
+        left_buckle = False
+        right_buckle = False
+        for buckle in buckles:
+            buckle_center = ((buckle[0] + buckle[2]) / 2,
+                             (buckle[1] + buckle[3]) / 2)
+            if buckle_center[1] < shadetop[1] or (
+                    buckle_center[1] > shadetop[3]):
+                continue
+            if buckle_center[0] < shadetop[0] or (
+                    buckle_center[0] > shadetop[2]):
+                continue
+            if buckle_center[0] < shadetop_center[0]:
+                left_buckle = True
+            else:
+                right_buckle = True
+        if left_buckle and right_buckle:
+            break
+
+    return int(left_buckle) + int(right_buckle)
+
+
+def _loop_bulb_in_shade(shadetops, bulbtops):
+    for shadetop in shadetops:
+        shadetop_center = (float(shadetop[0] + shadetop[2]) / 2,
+                           float(shadetop[1] + shadetop[3]) / 2)
+        shadetop_width = float(shadetop[2] - shadetop[0])
+        shadetop_height = float(shadetop[3] - shadetop[1])
+
+        for bulbtop in bulbtops:
+            bulbtop_center = (float(bulbtop[0] + bulbtop[2]) / 2,
+                              float(bulbtop[1] + bulbtop[3]) / 2)
+            if bulbtop_center[1] < shadetop[1] or (
+                    bulbtop_center[1] > shadetop[3]):
+                continue
+            if bulbtop_center[0] < shadetop[0] or (
+                    bulbtop_center[0] > shadetop[2]):
+                continue
+            if (bulbtop_center[0] < shadetop_center[0] -
+                shadetop_width * 0.25) or (
+                    bulbtop_center[0] > shadetop_center[0] +
+                    shadetop_width * 0.25):
+                continue
+            if (bulbtop_center[1] < shadetop_center[1] - shadetop_height *
+                0.25) or (bulbtop_center[1] > shadetop_center[1] +
+                          shadetop_height * 0.25):
+                continue
+
+            return True
+
+    return False
+
+
+def _random_boxes(rng, max_boxes, snap):
+    '''Return float32 detection rows. If snap is True, coordinates are
+    rounded so that many boxes share edges and centers.'''
+    boxes = rng.uniform(0, 640, (rng.randint(1, max_boxes + 1), 5))
+    if snap:
+        boxes = np.round(boxes / 20) * 20
+    boxes[:, 2:4] = boxes[:, 0:2] + np.abs(boxes[:, 2:4] - boxes[:, 0:2])
+    boxes[:, 4] = 0.9
+    return boxes.astype(np.float32)
+
+
+def _points_on_band_edges(ref_boxes, axis, other_coords):
+    '''Return zero size boxes whose centers are at the float32 value
+    nearest to, and one float32 step either side of, the edges of the
+    center band of each box in ref_boxes. The edges are computed in float64,
+    like the loops above. other_coords gives the coordinate of each point on
+    the other axis.'''
+    centers = (ref_boxes[:, axis] + ref_boxes[:, axis + 2]) / 2
+    margins = (ref_boxes[:, axis + 2] - ref_boxes[:, axis]) * 0.25
+    centers = centers.astype(np.float64)
+    margins = margins.astype(np.float64)
+    coords = []
+    for edge in np.concatenate((centers - margins, centers + margins)):
+        edge = np.float32(edge)
+        coords.extend((np.nextafter(edge, np.float32(-np.inf)), edge,
+                       np.nextafter(edge, np.float32(np.inf))))
+
+    points = np.zeros((len(coords), 5), dtype=np.float32)
+    points[:, axis] = coords
+    points[:, axis + 2] = coords
+    points[:, 1 - axis] = np.resize(other_coords, len(coords))
+    points[:, 3 - axis] = points[:, 1 - axis]
+    return points
+
+
+class SpatialRulesTest(unittest.TestCase):
+    def _check(self, rng, snap):
+        bases = _random_boxes(rng, 6, snap)
+        pipes = _random_boxes(rng, 6, snap)
+        shadetops = _random_boxes(rng, 6, snap)
+        small = _random_boxes(rng, 8, snap)
+        dets_for_class = {
+            cv_rules.BASE: bases,
+            cv_rules.PIPE: pipes,
+            cv_rules.SHADETOP: shadetops,
+            cv_rules.BUCKLE: small,
+            cv_rules.BULBTOP: small,
+        }
+
+        self.assertEqual(cv_rules._pipe_on_base(dets_for_class),
+                         _loop_pipe_on_base(bases, pipes))
+        self.assertEqual(cv_rules._count_buckles(shadetops, small),
+                         _loop_count_buckles(shadetops, small))
+        self.assertEqual(cv_rules._bulb_in_shade(dets_for_class),
+                         _loop_bulb_in_shade(shadetops, small))
+
+    def test_random_frames(self):
+        rng = np.random.RandomState(0)
+        for i in range(NUM_RANDOM_FRAMES):
+            self._check(rng, snap=False)
+
+    def test_shared_edges(self):
+        rng = np.random.RandomState(1)
+        for i in range(NUM_RANDOM_FRAMES):
+            self._check(rng, snap=True)
+
+    def test_pipe_on_band_edges(self):
+        rng = np.random.RandomState(2)
+        for i in range(500):
+            bases = _random_boxes(rng, 3, snap=False)
+            pipes = _points_on_band_edges(bases, 0, bases[:, 1])
+
+            # Tall enough and above the base center, so only the band
+            # decides
+            pipes[:, 1] = -2 * (bases[:, 3] - bases[:, 1]).max()
+            pipes[:, 3] = 0
+            for pipe in pipes:
+                dets_for_class = {
+                    cv_rules.BASE: bases, cv_rules.PIPE: pipe[np.newaxis]}
+                self.assertEqual(
+                    cv_rules._pipe_on_base(dets_for_class),
+                    _loop_pipe_on_base(bases, pipe[np.newaxis]))
+
+    def test_bulbtop_on_band_edges(self):
+        rng = np.random.RandomState(3)
+        for i in range(500):
+            shadetops = _random_boxes(rng, 3, snap=False)
+            centers = (shadetops[:, 0:2] + shadetops[:, 2:4]) / 2
+            for axis in (0, 1):
+                bulbtops = _points_on_band_edges(
+                    shadetops, axis, centers[:, 1 - axis])
+                for bulbtop in bulbtops:
+                    dets_for_class = {
+                        cv_rules.SHADETOP: shadetops,
+                        cv_rules.BULBTOP: bulbtop[np.newaxis],
+                    }
+                    self.assertEqual(
+                        cv_rules._bulb_in_shade(dets_for_class),
+                        _loop_bulb_in_shade(shadetops, bulbtop[np.newaxis]))
+
+    def test_float32_edge_outside_band(self):
+        # Computed in float32, the lower edge of this base's band rounds
+        # down to the pipe's x. Computed in float64, as the loops did, it is
+        # just above it, so the pipe is outside the band.
+        bases = np.array([[280.0558166503906, 0, 570.7347412109375, 10, 0.9]],
+                         dtype=np.float32)
+        pipes = np.array([[352.72552490234375, -100, 352.72552490234375, 0,
+                           0.9]], dtype=np.float32)
+        self.assertEqual((bases[0, 0] + bases[0, 2]) / 2 -
+                         (bases[0, 2] - bases[0, 0]) * np.float32(0.25),
+                         pipes[0, 0])
+
+        centered = geometry.within_band(
+            geometry.centers(bases), geometry.widths(bases), 0.25,
+            geometry.centers(pipes), geometry.X)
+        self.assertFalse(centered[0, 0])
+
+        # The pipe is tall enough and above the base center, so only the
+        # band decides
+        dets_for_class = {cv_rules.BASE: bases, cv_rules.PIPE: pipes}
+        self.assertFalse(cv_rules._pipe_on_base(dets_for_class))
+        self.assertFalse(_loop_pipe_on_base(bases, pipes))
+
+    def test_no_buckles(self):
+        empty = np.zeros((0, 5), dtype=np.float32)
+        shadetops = _random_boxes(np.random.RandomState(4), 3, snap=False)
+        self.assertEqual(cv_rules._count_buckles(shadetops, empty),
+                         _loop_count_buckles(shadetops, empty))
+
+
+if __name__ == '__main__':
+    unittest.main()
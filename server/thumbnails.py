@@ -0,0 +1,18 @@
+'''Small gray thumbnails that frames are compared with.
+
+Each thumbnail pixel is the average of a block of the frame, so noise mostly
+cancels out. The engine makes one thumbnail per frame, and both
+DuplicateFilter and BoxTracker compare that one.'''
+
+import cv2
+
+
+# Width and height of thumbnails
+THUMBNAIL_SIZE = (64, 48)
+
+
+def gray_thumbnail(img):
+    '''Return the gray thumbnail of a BGR image. It is scaled down before
+    the conversion to gray, so only the thumbnail gets converted.'''
+    small = cv2.resize(img, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)